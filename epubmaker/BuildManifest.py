@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+
+BuildManifest.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Remember what went into each output file, so we can skip rebuilding
+outputs whose inputs did not change.
+
+The manifest is a json file in the output directory.  For every
+output file it records the epubmaker version, a hash of the relevant
+options and the sha1 of every input file.
+
+The hashes of input files are memoized for the duration of one book,
+so checking many output formats reads every input only once.
+
+"""
+
+from __future__ import with_statement
+
+import os
+import hashlib
+import json
+import urllib
+import urlparse
+
+from epubmaker.lib.Logger import debug, warn
+from epubmaker.Version import VERSION
+from epubmaker import ParserFactory
+from epubmaker.CommonOptions import Options
+
+options = Options()
+
+# options that change the output
+CONFIG_OPTIONS = """max_depth local_files_only include_argument exclude
+include_mediatypes_argument exclude_mediatypes rewrite title author ebook
+inputencoding mediatype_from_extension coverpage_url_argument section_tags
+packager reproducible""".split ()
+
+hashes = {} # url -> sha1 of the contents, for the book being built
+
+
+def hash_data (data):
+    """ Hash some bytes. """
+    return hashlib.sha1 (data).hexdigest ()
+
+
+def clear ():
+    """ Forget all memoized hashes. Call at the start of every book. """
+    hashes.clear ()
+
+
+def hash_url (url):
+    """ Hash the contents of url. Return None if url cannot be read.
+
+    The result is memoized until clear () is called.
+
+    """
+
+    if url not in hashes:
+        hashes[url] = _hash_url (url)
+    return hashes[url]
+
+
+def _hash_url (url):
+    """ Hash the contents of url. Return None if url cannot be read. """
+
+    try:
+        if urlparse.urlparse (url).scheme in ('', 'file'):
+            with open (urllib.url2pathname (urlparse.urlparse (url).path), 'rb') as fp:
+                return hash_data (fp.read ())
+        fp = ParserFactory.open_url (url)
+        try:
+            return hash_data (fp.read ())
+        finally:
+            fp.close ()
+    except IOError:
+        return None
+
+
+def config_hash ():
+    """ Hash the options and config values that influence the output. """
+
+    config = dict ([(name, getattr (options, name, None)) for name in CONFIG_OPTIONS])
+    config['config'] = sorted (vars (options.config).items ())
+    return hash_data (json.dumps (config, sort_keys = True, default = repr))
+
+
+class BuildManifest (object):
+    """ The build manifest of one book. """
+
+    def __init__ (self, filename):
+        self.filename = filename
+        self.outputs = {}
+
+        try:
+            with open (filename) as fp:
+                self.outputs = json.load (fp).get ('outputs', {})
+        except IOError:
+            pass
+        except ValueError, what:
+            warn ("Ignoring corrupt build manifest %s: %s" % (filename, what))
+
+
+    def is_up_to_date (self, outputfile, config):
+        """ Check if outputfile was built from the same inputs. """
+
+        entry = self.outputs.get (outputfile)
+        if entry is None:
+            return False
+        if entry.get ('version') != VERSION or entry.get ('config') != config:
+            return False
+        if not os.path.exists (os.path.join (options.outputdir, outputfile)):
+            return False
+
+        for url, sha1 in entry.get ('inputs', {}).iteritems ():
+            if hash_url (url) != sha1:
+                debug ("%s changed" % url)
+                return False
+
+        return True
+
+
+    def get_aux_files (self, outputfile):
+        """ Return the auxiliary files recorded for outputfile or None. """
+
+        return self.outputs.get (outputfile, {}).get ('aux_files')
+
+
+    def record (self, outputfile, config, inputs, aux_files = None):
+        """ Record the inputs of an output file that was just built.
+
+        aux_files is the list of images that go with the output file,
+        packagers need it even if the output file is up to date.
+
+        """
+
+        # the output file may be an input of a later format
+        hashes.pop (os.path.join (options.outputdir, outputfile), None)
+
+        self.outputs[outputfile] = {
+            'version': VERSION,
+            'config': config,
+            'inputs': inputs,
+            }
+        if aux_files is not None:
+            self.outputs[outputfile]['aux_files'] = list (aux_files)
+        self.save ()
+
+
+    def forget (self, outputfile):
+        """ Forget an output file, eg. because the build failed. """
+
+        if self.outputs.pop (outputfile, None) is not None:
+            self.save ()
+
+
+    def save (self):
+        """ Write the manifest. """
+
+        tmpname = self.filename + '.tmp'
+        try:
+            with open (tmpname, 'w') as fp:
+                json.dump ({ 'version': VERSION, 'outputs': self.outputs },
+                           fp, sort_keys = True, indent = 1)
+            os.rename (tmpname, self.filename)
+        except (IOError, OSError), what:
+            warn ("Cannot write build manifest %s: %s" % (self.filename, what))
@@ -65,6 +65,35 @@ def add_common_options (op):
         action   = "append",
         help     = "split epub on TAG.CLASS")
 
+    op.add_option (
+        "--cache-dir",
+        metavar  = "DIR",
+        dest     = "cache_dir", 
+        default  = '~/.cache/epubmaker',
+        help     = "cache intermediate results in DIR (default: ~/.cache/epubmaker)")
+
+    op.add_option (
+        "--cache-size",
+        metavar  = "MB",
+        dest     = "cache_size", 
+        type     = "int",
+        default  = 1024,
+        help     = "limit the cache to MB megabytes (default: 1024)")
+
+    op.add_option (
+        "--no-cache",
+        dest     = "no_cache", 
+        action   = "store_true",
+        default  = False,
+        help     = "do not use the cache")
+
+    op.add_option (
+        "--cache-tidy",
+        dest     = "cache_tidy", 
+        action   = "store_true",
+        default  = False,
+        help     = "cache the output of tidy (default: off)")
+
 
 def get_parser (**kwargs):
     op = optparse.OptionParser (**kwargs)
@@ -19,19 +19,31 @@ from __future__ import with_statement
 import sys
 import os.path
 import re
+import copy
+import time
+import datetime
+import urllib
+import urlparse
+import json
+import shlex
+import pipes
+import signal
 import optparse
+import multiprocessing
 import hashlib
 import mimetypes
 
 from epubmaker.lib.GutenbergGlobals import Struct, DCIMT, SkipOutputFormat
 import epubmaker.lib.GutenbergGlobals as gg
-from epubmaker.lib.Logger import debug, exception
-from epubmaker.lib import Logger, DublinCore
+from epubmaker.lib.Logger import debug, info, error, exception
+from epubmaker.lib import Logger, DublinCore, ExternalTools, Cache, ArchiveURL
 
 from epubmaker import ParserFactory
+from epubmaker import Spider
 from epubmaker import WriterFactory
 from epubmaker.packagers import PackagerFactory
 from epubmaker import CommonOptions
+from epubmaker import BuildManifest
 
 from epubmaker.Version import VERSION
 
@@ -80,6 +92,8 @@ FILENAMES = {
 
     'picsdir.noimages': '{id}-noimages.picsdir',   # do we need this ?
     'picsdir.images':   '{id}-images.picsdir',     # do we need this ?
+
+    'manifest':         '{id}-manifest.json',
     }
 
 def make_output_filename (dc, type_):
@@ -90,8 +104,8 @@ def make_output_filename (dc, type_):
         # not a PG ebook
         return FILENAMES[type_].format (id = gg.string_to_filename (dc.title)[:65])
 
-def main ():
-    """ Main program. """
+def get_option_parser ():
+    """ Build the option parser. """
 
     op = optparse.OptionParser (usage = "usage: %prog [options] url", 
                                 version = "EpubMaker version %s" % VERSION)
@@ -215,181 +229,608 @@ def main ():
 
     op.add_option (
         "--cover",
-        dest    = "coverpage_url",
+        dest    = "coverpage_url_argument",
         default = None,
         help    = "add the specified cover to the epub")
 
-    options, args = CommonOptions.parse_args (op, {}, {
-        'proxies': None,
-        'bibrec': 'http://www.gutenberg.org/ebooks/',
-        'xelatex': 'xelatex',
-        'mobigen': 'kindlegen',
-        'groff': 'groff',
-        'rhyming_dict': None,
-        } )
+    op.add_option (
+        "--batch",
+        metavar = "FILE",
+        dest    = "batch", 
+        default = None,
+        help    = "read jobs from FILE, one job per line (- == stdin)")
 
-    if not args:
-        op.error ("please specify which file to convert")
+    op.add_option (
+        "--batch-results",
+        metavar = "FILE",
+        dest    = "batch_results", 
+        default = '-',
+        help    = "write one result record per book to FILE (default: stdout)")
 
-    Logger.set_log_level (options.verbose)        
+    op.add_option (
+        "--fetch-threads",
+        metavar = "N",
+        dest    = "fetch_threads", 
+        type    = "int",
+        default = 8,
+        help    = "download up to N files in parallel (default: 8, 0 == no prefetching)")
 
-    options.types = options.types or ['all']
-    for opt, formats in DEPENDENCIES:
-        if opt in options.types:
-            options.types.remove (opt)
-            options.types += formats
-
-    if set (options.types).intersection (('html.images', 'pdf.images', 'rst.gen')):
-        options.types.insert (0, 'picsdir.images')
-    if set (options.types).intersection (('html.noimages', 'pdf.noimages')):
-        options.types.insert (0, 'picsdir.noimages')
-    if set (options.types).intersection (('kindle.images', )):
-        options.types.insert (0, 'epub.images')
-    if set (options.types).intersection (('kindle.noimages', )):
-        options.types.insert (0, 'epub.noimages')
-        
-        
-    debug ("Building types: %s" % ' '.join (options.types))
+    op.add_option (
+        "--image-processes",
+        metavar = "N",
+        dest    = "image_processes", 
+        type    = "int",
+        default = 0,
+        help    = "resize images in N processes (default: 0 == one per cpu, "
+                  "or 1 when building books in parallel)")
 
-    ParserFactory.load_parsers ()
-    WriterFactory.load_writers ()
+    op.add_option (
+        "--zip-threads",
+        metavar = "N",
+        dest    = "zip_threads", 
+        type    = "int",
+        default = 0,
+        help    = "compress zip members in N threads (default: 0 == one per cpu, "
+                  "or 1 when building books in parallel)")
 
-    packager_factory = None
-    if options.packager != 'none':
-        packager_factory = PackagerFactory (options.packager)
-        packager_factory.load ()
+    op.add_option (
+        "--parser-cache-size",
+        metavar = "MB",
+        dest    = "parser_cache_size", 
+        type    = "int",
+        default = 1024,
+        help    = "try to keep parsed files in memory below MB megabytes "
+                  "(default: 1024, 0 == no limit)")
 
-    for url in args:
+    op.add_option (
+        "--force",
+        dest    = "force", 
+        action  = "store_true",
+        default = False,
+        help    = "rebuild all formats even if their inputs did not change")
 
-        if options.include_argument:
-            options.include = options.include_argument[:]
-        else:
-            exclude_patt = os.path.dirname (url) + '/*'
-            options.include = [ exclude_patt ]
-            if exclude_patt.startswith ('/'):
-                options.include.append('file://' + exclude_patt)
-            
-        # try to get metadata
+    op.add_option (
+        "--reproducible",
+        dest    = "reproducible", 
+        action  = "store_true",
+        default = False,
+        help    = "make byte-identical output from identical input: take all "
+                  "timestamps from SOURCE_DATE_EPOCH, the source file or the "
+                  "release date")
 
-        options.candidate = Struct ()
-        options.candidate.filename = url
-        options.candidate.mediatype = str (DCIMT (
-            mimetypes.types_map[os.path.splitext (url)[1]], options.inputencoding))
+    op.add_option (
+        "--jobs",
+        metavar = "N",
+        dest    = "jobs", 
+        type    = "int",
+        default = 1,
+        help    = "build N books in parallel, each in its own process (default: 1)")
 
-        options.include_mediatypes = options.include_mediatypes_argument[:]
-        options.want_images = False
-        #options.coverpage_url = None
+    op.add_option (
+        "--job-timeout",
+        metavar = "SECONDS",
+        dest    = "job_timeout", 
+        type    = "int",
+        default = 0,
+        help    = "kill the build of a book after SECONDS (default: 0 == never)")
 
-        parser = ParserFactory.ParserFactory.create (options.candidate.filename, {})
+    op.add_option (
+        "--max-tools",
+        metavar = "N",
+        dest    = "max_tools", 
+        type    = "int",
+        default = 0,
+        help    = "run at most N external tools (tidy, groff, xelatex, kindlegen) "
+                  "at the same time (default: 0 == no limit)")
 
-        dc = None
+    return op
 
-        try:
-            dc = DublinCore.GutenbergDublinCore ()
 
-            # try for rst header
-            dc.load_from_rstheader (parser.unicode_content ())
+def expand_types (types):
+    """ Expand format aliases and add the formats they depend on. """
+
+    types = types[:] or ['all']
+    for opt, formats in DEPENDENCIES:
+        if opt in types:
+            types.remove (opt)
+            types += formats
+
+    if set (types).intersection (('html.images', 'pdf.images', 'rst.gen')):
+        types.insert (0, 'picsdir.images')
+    if set (types).intersection (('html.noimages', 'pdf.noimages')):
+        types.insert (0, 'picsdir.noimages')
+    if set (types).intersection (('kindle.images', )):
+        types.insert (0, 'epub.images')
+    if set (types).intersection (('kindle.noimages', )):
+        types.insert (0, 'epub.noimages')
+
+    return types
 
-            if dc.project_gutenberg_id == 0:
-                # try for Project Gutenberg header
-                dc.load_from_parser (parser)
 
-        except (ValueError, TypeError):
-            # use standard HTML header
-            dc = DublinCore.DublinCore ()
+def get_dc (url):
+    """ Get the metadata for the book at url. """
+
+    parser = ParserFactory.ParserFactory.create (options.candidate.filename, {})
+
+    dc = None
+
+    try:
+        dc = DublinCore.GutenbergDublinCore ()
+
+        # try for rst header
+        dc.load_from_rstheader (parser.unicode_content ())
+
+        if dc.project_gutenberg_id == 0:
+            # try for Project Gutenberg header
             dc.load_from_parser (parser)
-            dc.source = url
 
+    except (ValueError, TypeError):
+        # use standard HTML header
+        dc = DublinCore.DublinCore ()
+        dc.load_from_parser (parser)
         dc.source = url
 
-        if options.title:
-            dc.title = options.title
-        if not dc.title:
-            dc.title = 'NA'
+    dc.source = url
 
-        if options.author:
-            dc.add_author (options.author, 'cre')
-        if not dc.authors:
-            dc.add_author ('NA', 'cre')
+    if options.title:
+        dc.title = options.title
+    if not dc.title:
+        dc.title = 'NA'
 
-        if options.ebook:
-            dc.project_gutenberg_id = options.ebook
+    if options.author:
+        dc.add_author (options.author, 'cre')
+    if not dc.authors:
+        dc.add_author ('NA', 'cre')
 
-        if dc.project_gutenberg_id:
-            dc.opf_identifier = ('http://www.gutenberg.org/ebooks/%d' % dc.project_gutenberg_id)
-        else:
-            dc.opf_identifier = ('urn:mybooks:%s' %
-                                 hashlib.md5 (url.encode ('utf-8')).hexdigest ())
-
-        if not dc.languages:
-            # we *need* a language to build a valid epub, so just make one up
-            dc.add_lang_id ('en')
-
-        aux_file_list = []
-        
-        for type_ in options.types:
-            debug ('=== Building %s ===' % type_)
-            maintype, subtype = os.path.splitext (type_)
-
-            try:
-                writer = WriterFactory.create (maintype)
-                writer.setup (options)
-                options.type = type_
-                options.maintype = maintype
-                options.subtype = subtype
-                options.want_images = False
-
-                options.include_mediatypes = options.include_mediatypes_argument[:]
-                if subtype == '.images':
-                    options.include_mediatypes.append ('image/*')
-                    options.want_images = True
-                else:
-                    # This is the mediatype of the 'broken' image.
-                    options.include_mediatypes.append ('image/png;type=resource')
+    if options.ebook:
+        dc.project_gutenberg_id = options.ebook
+
+    if dc.project_gutenberg_id:
+        dc.opf_identifier = ('http://www.gutenberg.org/ebooks/%d' % dc.project_gutenberg_id)
+    else:
+        dc.opf_identifier = ('urn:mybooks:%s' %
+                             hashlib.md5 (url.encode ('utf-8')).hexdigest ())
+
+    if not dc.languages:
+        # we *need* a language to build a valid epub, so just make one up
+        dc.add_lang_id ('en')
 
-                writer.parse (options)
+    return dc
 
-                if maintype in ('html', ):
-                    # list of images for packager
-                    aux_file_list[:] = writer.get_aux_file_list ()
 
-                options.dc = dc
-                options.outputfile = make_output_filename (dc, type_)
+def get_build_time (url, dc):
+    """ Get a fixed timestamp for a reproducible build.
 
-                if maintype == 'kindle':
-                    options.epub_filename = make_output_filename (dc, 'epub' + subtype)
+    Use SOURCE_DATE_EPOCH if set, else the mtime of the source file,
+    else the release date of the book.
 
-                writer.build ()
+    """
 
-                if options.validate:
-                    writer.validate ()
+    try:
+        return datetime.datetime.fromtimestamp (
+            int (os.environ['SOURCE_DATE_EPOCH']), gg.UTC ())
+    except (KeyError, ValueError):
+        pass
+
+    u = urlparse.urlparse (url)
+    filename = None
+    if u.scheme in ('', 'file'):
+        filename = urllib.url2pathname (u.path)
+    elif ArchiveURL.is_archive_url (url):
+        filename = ArchiveURL.split_url (url)[1]
+    if filename:
+        try:
+            return datetime.datetime.fromtimestamp (
+                os.path.getmtime (filename), gg.UTC ())
+        except OSError:
+            pass
+
+    if dc.release_date:
+        return datetime.datetime.combine (
+            dc.release_date, datetime.time (tzinfo = gg.UTC ()))
+
+    # the earliest date a zip file can hold
+    return datetime.datetime (1980, 1, 1, tzinfo = gg.UTC ())
+
+
+def build_book (url, packager_factory = None):
+    """ Build all requested formats of one book.
+
+    Returns a dict of output type -> 'ok' | 'uptodate' | 'skipped' | 'failed'.
+
+    """
+
+    # start every book with a clean slate
+    ParserFactory.ParserFactory.clear ()
+    Spider.LinkGraph.clear ()
+    ArchiveURL.close ()
+    BuildManifest.clear ()
+    Cache.setup (None if options.no_cache else options.cache_dir, options.cache_size)
+
+    if options.include_argument:
+        options.include = options.include_argument[:]
+    else:
+        exclude_patt = os.path.dirname (url) + '/*'
+        options.include = [ exclude_patt ]
+        if exclude_patt.startswith ('/'):
+            options.include.append('file://' + exclude_patt)
+
+    # try to get metadata
+
+    options.candidate = Struct ()
+    options.candidate.filename = url
+    options.candidate.mediatype = str (DCIMT (
+        mimetypes.types_map[os.path.splitext (url)[1]], options.inputencoding))
+
+    options.include_mediatypes = options.include_mediatypes_argument[:]
+    options.want_images = False
+    options.coverpage_url = options.coverpage_url_argument
+
+    dc = get_dc (url)
+    Logger.ebook = dc.project_gutenberg_id or 0
+
+    options.build_time = None
+    if options.reproducible:
+        options.build_time = dc.modified = get_build_time (url, dc)
+        debug ("Reproducible build, timestamp: %s" % options.build_time.isoformat ())
+
+    manifest = BuildManifest.BuildManifest (
+        os.path.join (options.outputdir, make_output_filename (dc, 'manifest')))
+
+    aux_file_list = []
+    results = {}
+
+    for type_ in options.types:
+        debug ('=== Building %s ===' % type_)
+        maintype, subtype = os.path.splitext (type_)
+
+        try:
+            writer = WriterFactory.create (maintype)
+            writer.setup (options)
+            options.type = type_
+            options.maintype = maintype
+            options.subtype = subtype
+            options.want_images = False
+
+            options.include_mediatypes = options.include_mediatypes_argument[:]
+            if subtype == '.images':
+                options.include_mediatypes.append ('image/*')
+                options.want_images = True
+            else:
+                # This is the mediatype of the 'broken' image.
+                options.include_mediatypes.append ('image/png;type=resource')
+
+            options.dc = dc
+            options.outputfile = make_output_filename (dc, type_)
+
+            if maintype == 'kindle':
+                options.epub_filename = make_output_filename (dc, 'epub' + subtype)
+
+            # picsdir is a helper for other formats: always build it
+            config = BuildManifest.config_hash ()
+            if (maintype != 'picsdir' and not options.force and
+                manifest.is_up_to_date (options.outputfile, config)):
+                # the packager needs the list of images from the last build
+                aux_files = manifest.get_aux_files (options.outputfile)
+                if maintype not in ('html', ) or aux_files is not None:
+                    if aux_files is not None:
+                        aux_file_list[:] = aux_files
+                    info ("%s is up to date" % options.outputfile)
+                    options.outputfile = None
+                    results[type_] = 'uptodate'
+                    continue
+
+            writer.parse (options)
+
+            aux_files = None
+            if maintype in ('html', ):
+                # list of images for packager
+                aux_file_list[:] = writer.get_aux_file_list ()
+                aux_files = aux_file_list
+
+            writer.build ()
+
+            if options.validate:
+                writer.validate ()
+
+            if packager_factory:
+                try:
+                    packager = packager_factory.create (type_)
+                    packager.setup (options)
+                    packager.package (aux_file_list)
+                except KeyError:
+                    # no such packager
+                    pass
+
+            if maintype != 'picsdir':
+                manifest.record (options.outputfile, config,
+                                 writer.get_dependencies (), aux_files)
+
+            options.outputfile = None
+            results[type_] = 'ok'
+
+        except SkipOutputFormat:
+            results[type_] = 'skipped'
+            continue
+
+        except StandardError, what:
+            exception ("%s" % what)
+            results[type_] = 'failed'
+            if options.outputfile:
+                manifest.forget (options.outputfile)
+
+    if options.packager == 'ww':
+        try:
+            packager = packager_factory.create ('push')
+            options.outputfile = '%d-final.zip' % (dc.project_gutenberg_id)
+            packager.setup (options)
+            packager.package (aux_file_list)
+        except KeyError:
+            # no such packager
+            pass
 
-                if packager_factory:
+    # free memory and remove spill files before the next book
+    ParserFactory.ParserFactory.clear ()
+    Logger.ebook = 0
+
+    return results
+
+
+def read_batch (fp):
+    """ Read a batch file. Yield one argument list per job.
+
+    A job is one line of options and urls, as you would write them
+    on the command line.  Empty lines and lines starting with # are
+    ignored.
+
+    """
+
+    for line in fp:
+        line = line.strip ()
+        if line and not line.startswith ('#'):
+            yield shlex.split (line)
+
+
+def job_options (op, base_options, argv):
+    """ Build the options for one batch job.
+
+    Options given on the job line override the options given on the
+    command line, which in turn override the defaults.
+
+    """
+
+    defaults = op.get_default_values ()
+    values, args = op.parse_args (argv, op.get_default_values ())
+
+    job = copy.deepcopy (base_options)
+    for name, value in vars (values).items ():
+        if value != getattr (defaults, name, None):
+            job[name] = value
+
+    return job, args
+
+
+def iter_jobs (op, base_options, infile, outfile):
+    """ Yield (argv, job options, url) for every book in the batch file. """
+
+    for argv in read_batch (infile):
+        try:
+            job, args = job_options (op, base_options, argv)
+        except SystemExit:
+            # optparse already complained
+            write_record (outfile, { 'args': argv, 'status': 'failed',
+                                     'error': 'bad job line' })
+            continue
+
+        for url in args:
+            yield argv, job, url
+
+
+def write_record (outfile, record):
+    """ Write one result record. """
+
+    outfile.write (json.dumps (record, sort_keys = True) + '\n')
+    outfile.flush ()
+
+
+def run_job (argv, job, url, packager_factory):
+    """ Build one book in this process. Return the result record. """
+
+    # isolate per-book state
+    options.__dict__.clear ()
+    options.update (copy.deepcopy (job))
+    options.types = expand_types (options.types)
+
+    record = { 'source': url, 'args': argv }
+    start = time.time ()
+    try:
+        record['formats'] = build_book (url, packager_factory)
+        record['status'] = 'ok'
+        if 'failed' in record['formats'].values ():
+            record['status'] = 'failed'
+    except StandardError, what:
+        exception ("Error building %s: %s" % (url, what))
+        record['status'] = 'failed'
+        record['error'] = str (what)
+        Logger.ebook = 0
+
+    record['elapsed'] = round (time.time () - start, 3)
+    return record
+
+
+def pool_worker (index, argv, job, url, packager_factory, conn):
+    """ Body of a worker process.
+
+    The worker gets its own process group, so that when we kill it
+    we also kill any external tool it may have spawned.
+
+    """
+
+    try:
+        os.setpgrp ()
+    except (AttributeError, OSError):
+        pass
+
+    ExternalTools.worker_index = index
+
+    # the books are already built in parallel
+    if not job.get ('image_processes'):
+        job = dict (job, image_processes = 1)
+    if not job.get ('zip_threads'):
+        job = dict (job, zip_threads = 1)
+
+    conn.send (run_job (argv, job, url, packager_factory))
+    conn.close ()
+
+
+def kill_worker (process):
+    """ Kill a worker process and all its children. """
+
+    try:
+        os.killpg (process.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        process.terminate ()
+    process.join ()
+
+
+def run_pool (jobs, packager_factory, outfile):
+    """ Build books in parallel, one worker process per book.
+
+    A worker that crashes or exceeds the timeout only takes its own
+    book down.
+
+    """
+
+    n_workers = max (options.jobs, 1)
+    timeout = options.job_timeout
+    ExternalTools.setup (options.max_tools, n_workers)
+
+    free = range (n_workers - 1, -1, -1)
+    running = {} # index -> (process, conn, record, start)
+
+    try:
+        while True:
+            while free:
+                try:
+                    argv, job, url = jobs.next ()
+                except StopIteration:
+                    break
+                index = free.pop ()
+                parent_conn, child_conn = multiprocessing.Pipe (False)
+                process = multiprocessing.Process (
+                    target = pool_worker,
+                    args = (index, argv, job, url, packager_factory, child_conn))
+                process.start ()
+                child_conn.close ()
+                running[index] = (process, parent_conn,
+                                  { 'source': url, 'args': argv }, time.time ())
+
+            if not running:
+                break
+
+            time.sleep (0.1)
+
+            for index, (process, conn, record, start) in running.items ():
+                elapsed = time.time () - start
+                crashed = False
+                if conn.poll ():
                     try:
-                        packager = packager_factory.create (type_)
-                        packager.setup (options)
-                        packager.package (aux_file_list)
-                    except KeyError:
-                        # no such packager
-                        pass
-
-                options.outputfile = None
-
-            except SkipOutputFormat:
-                continue
-            
-            except StandardError, what:
-                exception ("%s" % what)
-
-        if options.packager == 'ww':
-            try:
-                packager = packager_factory.create ('push')
-                options.outputfile = '%d-final.zip' % (dc.project_gutenberg_id)
-                packager.setup (options)
-                packager.package (aux_file_list)
-            except KeyError:
-                # no such packager
-                pass
+                        record = conn.recv ()
+                    except EOFError:
+                        # the worker exited without sending a record
+                        crashed = True
+                    process.join ()
+                elif not process.is_alive ():
+                    process.join ()
+                    crashed = True
+                elif timeout and elapsed > timeout:
+                    kill_worker (process)
+                    record['status'] = 'timeout'
+                    error ("Worker for %s killed after %d seconds" % (
+                        record['source'], timeout))
+                else:
+                    continue
+
+                if crashed:
+                    record['status'] = 'crashed'
+                    record['exitcode'] = process.exitcode
+                    error ("Worker for %s died with exit code %s" % (
+                        record['source'], process.exitcode))
+
+                ExternalTools.release_worker (index)
+                record['elapsed'] = round (elapsed, 3)
+                conn.close ()
+                del running[index]
+                free.append (index)
+                write_record (outfile, record)
+
+    finally:
+        for process, dummy_conn, dummy_record, dummy_start in running.values ():
+            kill_worker (process)
+
+
+def run_batch (op, base_options, packager_factory, args = None):
+    """ Build all books listed in the batch file or on the command line. """
+
+    if args:
+        infile = [' '.join (map (pipes.quote, args))]
+    elif options.batch == '-':
+        infile = sys.stdin
+    else:
+        infile = open (options.batch)
+    outfile = sys.stdout if options.batch_results == '-' else open (options.batch_results, 'a')
+
+    try:
+        jobs = iter_jobs (op, base_options, infile, outfile)
+        if options.jobs > 1 or options.job_timeout:
+            run_pool (jobs, packager_factory, outfile)
+        else:
+            for argv, job, url in jobs:
+                write_record (outfile, run_job (argv, job, url, packager_factory))
+    finally:
+        if hasattr (infile, 'close') and infile is not sys.stdin:
+            infile.close ()
+        if outfile is not sys.stdout:
+            outfile.close ()
+
+
+def main ():
+    """ Main program. """
+
+    op = get_option_parser ()
+
+    options, args = CommonOptions.parse_args (op, {}, {
+        'proxies': None,
+        'bibrec': 'http://www.gutenberg.org/ebooks/',
+        'xelatex': 'xelatex',
+        'mobigen': 'kindlegen',
+        'groff': 'groff',
+        'rhyming_dict': None,
+        } )
+
+    if not args and not options.batch:
+        op.error ("please specify which file to convert")
+
+    Logger.set_log_level (options.verbose)        
+
+    ParserFactory.load_parsers ()
+    WriterFactory.load_writers ()
+
+    packager_factory = None
+    if options.packager != 'none':
+        packager_factory = PackagerFactory (options.packager)
+        packager_factory.load ()
+
+    if options.batch or options.jobs > 1 or options.job_timeout:
+        run_batch (op, copy.deepcopy (vars (options)), packager_factory,
+                   None if options.batch else args)
+        sys.exit (0)
+
+    options.types = expand_types (options.types)
+    debug ("Building types: %s" % ' '.join (options.types))
+
+    for url in args:
+        build_book (url, packager_factory)
 
     sys.exit (0)
 
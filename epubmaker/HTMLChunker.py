@@ -20,6 +20,7 @@ import urllib
 import os
 import re
 import copy
+import bisect
 
 from lxml import etree
 
@@ -42,6 +43,8 @@ SECTIONS = [
     ('p',           0.8)
     ]
 
+XHTML_PREFIX = NS.xhtml['']
+
 def xpath (node, path):
     """ xpath helper """
     return node.xpath (path, namespaces = gg.NSMAP)
@@ -50,6 +53,59 @@ def unicode_uri (uri):
     """ Normalize URI for idmap. """
     return urllib.unquote (uri).decode ('utf-8')
 
+def text_size (text):
+    """ Size of text in serialized HTML. """
+    if not text:
+        return 0
+    if isinstance (text, unicode):
+        # tostring () writes non-ascii chars as character references
+        return len (text.encode ('ascii', 'xmlcharrefreplace'))
+    return len (text)
+
+def has_id (e):
+    """ Is e an xhtml element with an id? """
+    return (isinstance (e.tag, basestring) and e.tag.startswith (XHTML_PREFIX)
+            and 'id' in e.attrib)
+
+def has_link (e):
+    """ Is e an xhtml element with a href or src? """
+    return (isinstance (e.tag, basestring) and e.tag.startswith (XHTML_PREFIX)
+            and ('href' in e.attrib or 'src' in e.attrib))
+
+def index_tree (tree):
+    """ Index all elements of tree.
+
+    Returns (nodes, index).  nodes is a list of all elements in
+    document order.  index maps every element to (size, start, end):
+    the estimated serialized size of the element including its tail,
+    and the range of its subtree in nodes.
+
+    Works bottom-up, so every subtree is measured only once.
+
+    """
+
+    nodes = list (tree.iter ())
+    index = {}
+
+    # in reverse document order all children come before their parent
+    for start in xrange (len (nodes) - 1, -1, -1):
+        e = nodes[start]
+        end = start + 1
+        if not isinstance (e.tag, basestring):
+            # comments, processing instructions etc.
+            size = len (etree.tostring (e))
+        else:
+            name = len (e.tag.rsplit ('}', 1)[-1])
+            size = 2 * name + 5 + text_size (e.text) + text_size (e.tail)
+            for k, v in e.attrib.iteritems ():
+                size += len (k.rsplit ('}', 1)[-1]) + text_size (v) + 4
+            for c in e:
+                c_size, dummy_start, end = index[c]
+                size += c_size
+        index[e] = (size, start, end)
+
+    return nodes, index
+
 
 class HTMLChunker (object):
     """ Splits HTML tree into smaller chunks.
@@ -67,8 +123,16 @@ class HTMLChunker (object):
         self.chunk = None
         self.chunk_body = None
         self.chunk_size = 0
+        self.chunk_ids = []
+        self.chunk_links = []
         self.next_id = 0
 
+        # index of the document being split
+        self.nodes = []
+        self.index = {}
+        self.id_positions = []
+        self.link_positions = []
+
         self.tags = {}
         for tag, size in SECTIONS:
             self.tags[NS.xhtml[tag]] = int (size * MAX_CHUNK_SIZE)
@@ -95,8 +159,23 @@ class HTMLChunker (object):
 
         """
         
+        # take the content out of the body while copying the tree,
+        # so we don't copy the whole book just to throw it away
+        saved = []
+        for c in xpath (tree, '//xhtml:body'):
+            while len (c) == 1:
+                c = c[0]
+            saved.append ((c, c.text, list (c)))
+            c.text = None
+            for child in saved[-1][2]:
+                c.remove (child)
+
         template = copy.deepcopy (tree)
 
+        for c, text, children in saved:
+            c.text = text
+            c.extend (children)
+
         for c in xpath (template, '//xhtml:body'):
 
             # descend while elem has only one child
@@ -117,21 +196,25 @@ class HTMLChunker (object):
         return template
 
 
-    def reset_chunk (self, template):
+    def reset_chunk (self, template, template_size):
         """ start a new chunk """
 
         self.chunk = copy.deepcopy (template)
-        self.chunk_size = len (etree.tostring (self.chunk))
+        self.chunk_size = template_size
         self.chunk_body = xpath (self.chunk, "//xhtml:body")[0]
         while len (self.chunk_body) == 1:
             self.chunk_body = self.chunk_body[0]
 
+        # the template is small, just search it
+        self.chunk_ids = [e for e in self.chunk.iter () if has_id (e)]
+        self.chunk_links = [e for e in self.chunk.iter () if has_link (e)]
+
 
     def shipout_chunk (self, url, chunk_id = None, comment = None):
         """ ready chunk to be shipped """
 
         if (self.chunk_size > MAX_CHUNK_SIZE):
-            self.split (self.chunk, url)
+            self._split (self.chunk, url)
             return
 
         url = unicode_uri (url)
@@ -141,8 +224,14 @@ class HTMLChunker (object):
         if not url in self.idmap:
             self.idmap[url] = chunk_name
 
+        ids = self.chunk_ids[:]
+        links = self.chunk_links[:]
+        for child in self.chunk_body:
+            ids.extend (self.find (child, self.id_positions, has_id))
+            links.extend (self.find (child, self.link_positions, has_link))
+
         # fragments of the page
-        for e in xpath (self.chunk, '//xhtml:*[@id]'):
+        for e in ids:
             id_ = e.attrib['id']
             old_id = "%s#%s" % (url, id_)
             # key is unicode string,
@@ -155,18 +244,64 @@ class HTMLChunker (object):
         self.chunks.append ( { 'name'     : chunk_name,
                                'id'       : chunk_id,
                                'comment'  : comment,
-                               'chunk'    : self.chunk,  } )
+                               'chunk'    : self.chunk,
+                               'links'    : links,       } )
             
         debug ("Adding chunk %s (%d bytes) %s" % (chunk_name, self.chunk_size, chunk_id))
 
 
+    def size (self, elem):
+        """ Get the estimated serialized size of elem. """
+        try:
+            return self.index[elem][0]
+        except KeyError:
+            # not part of the indexed document
+            dummy_nodes, index = index_tree (elem)
+            return index[elem][0]
+
+
+    def find (self, elem, positions, test):
+        """ Find all elements in subtree elem that pass test.
+
+        positions is the sorted list of the positions in self.nodes
+        of all indexed elements that pass test.
+
+        """
+
+        try:
+            dummy_size, start, end = self.index[elem]
+        except KeyError:
+            # not part of the indexed document
+            return [e for e in elem.iter () if test (e)]
+
+        return [self.nodes[n] for n in positions[
+            bisect.bisect_left (positions, start) : bisect.bisect_left (positions, end)]]
+
+
     def split (self, tree, url):
-        """ Split whole html or split chunk.
+        """ Split whole html.
 
         Find some arbitrary points to do it.
     
         """
 
+        self.nodes, self.index = index_tree (tree)
+        self.id_positions = [n for n, e in enumerate (self.nodes) if has_id (e)]
+        self.link_positions = [n for n, e in enumerate (self.nodes) if has_link (e)]
+
+        try:
+            self._split (tree, url)
+        finally:
+            # don't keep the elements alive
+            self.nodes = []
+            self.index = {}
+            self.id_positions = []
+            self.link_positions = []
+
+
+    def _split (self, tree, url):
+        """ Split whole html or split chunk. """
+
         for body in xpath (tree, "//xhtml:body"):
             # we can't split a node that has only one child
             # descend while elem has only one child
@@ -176,7 +311,8 @@ class HTMLChunker (object):
             debug ("body tag is %s" % body.tag)
 
             template = self.make_template (tree)
-            self.reset_chunk (template)
+            template_size = len (etree.tostring (template))
+            self.reset_chunk (template, template_size)
 
             # FIXME: is this ok ???
             # fixes patological one-element-body case
@@ -186,7 +322,7 @@ class HTMLChunker (object):
                 if not isinstance (child, etree.ElementBase):
                     # comments, processing instructions etc. 
                     continue
-                child_size = len (etree.tostring (child))
+                child_size = self.size (child)
 
                 try:
                     tags = [child.tag + '.' + c for c in child.attrib['class'].split ()]
@@ -212,7 +348,7 @@ class HTMLChunker (object):
                         debug ("chunk id is: %s" % (chunk_id or ''))
                         
                         self.shipout_chunk (url, chunk_id, comment)
-                        self.reset_chunk (template)
+                        self.reset_chunk (template, template_size)
                         break
 
                 self.chunk_body.append (child)
@@ -226,7 +362,21 @@ class HTMLChunker (object):
                 chunk_id = self.chunk_body[0].get ('id')
             comment = "Chunk: size=%d" % self.chunk_size
             self.shipout_chunk (url, chunk_id, comment)
-            self.reset_chunk (template)
+            self.reset_chunk (template, template_size)
+
+
+    def rewrite_chunk_links (self, chunk, f):
+        """ Rewrite all href and src in one chunk using f (). """
+
+        for link in chunk['links']:
+            url = link.get ('href')
+            if url is not None:
+                if not url.startswith('http://') and not url.startswith('https://'):
+                    link.set ('href', f (url))
+
+            url = link.get ('src')
+            if url is not None:
+                link.set ('src', f (url))
 
 
     def rewrite_links (self, f):
@@ -234,19 +384,31 @@ class HTMLChunker (object):
         
         for chunk in self.chunks:
             # chunk['name'] = f (chunk['name'])
-            
-            for link in xpath (chunk['chunk'], '//xhtml:*[@href]'):
-                url = link.get ('href')
-                if not url.startswith('http://') and not url.startswith('https://'):
-                    link.set ('href', f (url))
-
-            for image in xpath (chunk['chunk'], '//xhtml:*[@src]'):
-                image.set ('src', f (image.get ('src')))
+            self.rewrite_chunk_links (chunk, f)
 
         for k, v in self.idmap.items ():
             self.idmap[k] = f (v)
 
 
+    def rewrite_chunk_internal_links (self, chunk):
+        """ Rewrite the internal links of one chunk.
+
+        All documents the chunk links to must have been split.
+
+        """
+
+        for a in chunk['links']:
+            if a.get ('href') is None:
+                continue
+            try:
+                uri = unicode_uri (a.get ('href'))
+                a.set ('href', self.idmap[uri])
+            except KeyError:
+                ur, dummy_frag = urlparse.urldefrag (uri)
+                if ur in self.idmap:
+                    error ("HTMLChunker: Cannot rewrite internal link '%s'" % uri)
+
+
     def rewrite_internal_links (self):
         """ Rewrite links to point into right chunks.
 
@@ -256,16 +418,41 @@ class HTMLChunker (object):
 
         """
         for chunk in self.chunks:
-            for a in xpath (chunk['chunk'], "//xhtml:*[@href]"):
-                try:
-                    uri = unicode_uri (a.get ('href'))
-                    a.set ('href', self.idmap[uri])
-                except KeyError:
-                    ur, dummy_frag = urlparse.urldefrag (uri)
-                    if ur in self.idmap:
-                        error ("HTMLChunker: Cannot rewrite internal link '%s'" % uri)
+            self.rewrite_chunk_internal_links (chunk)
         
 
+    def is_resolvable (self, chunk, unsplit):
+        """ Check if the internal links of chunk can be rewritten now.
+
+        unsplit is the set of the urls of the documents that are
+        still to be split.
+
+        """
+
+        for a in chunk['links']:
+            href = a.get ('href')
+            if href is not None:
+                if urlparse.urldefrag (unicode_uri (href))[0] in unsplit:
+                    return False
+        return True
+
+
+    def pop_ready_chunks (self, unsplit):
+        """ Remove and return the chunks whose links can be rewritten.
+
+        Chunks come out in document order, so a chunk that links to
+        a document not yet split holds back all chunks after it.
+
+        """
+
+        n = 0
+        while n < len (self.chunks) and self.is_resolvable (self.chunks[n], unsplit):
+            n += 1
+        ready = self.chunks[:n]
+        del self.chunks[:n]
+        return ready
+
+
     def rewrite_internal_links_toc (self, toc):
         """ Rewrite links to point into right chunks.
 
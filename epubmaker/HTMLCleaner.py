@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+
+HTMLCleaner.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Applies many cleanup rules to a HTML tree in one walk.
+
+Every rule declares the tags and the classes of the elements it wants
+to see.  The cleaner walks the tree once and hands each element to
+the rules that want its tag or one of its classes.  Then the rules
+run in the order they were added, each over its own elements in
+document order.  Every rule sees the tree as the rules before it left
+it, just as if it had walked the tree by itself.
+
+Elements are matched before any rule runs, so a rule must check that
+an element it gets still is what it wants.  Elements dropped by an
+earlier rule, or inside a subtree dropped by an earlier rule, are not
+handed to later rules.  Elements created by a rule are not seen by
+any rule.
+
+"""
+
+from epubmaker.lib.Logger import debug
+
+
+class Rule (object):
+    """ A cleanup rule.
+
+    func (elem) is called for every element the rule matches.
+
+    tags and classes are sets of tags in Clark notation and of class
+    names.  A rule matches an element if its tag is in tags or it has
+    one of the classes.  If both are None the rule matches every node
+    in the tree, including comments and processing instructions.
+
+    """
+
+    def __init__ (self, func, tags = None, classes = None):
+        self.func = func
+        self.tags = frozenset (tags or ())
+        self.classes = frozenset (classes or ())
+        self.match_all = tags is None and classes is None
+
+
+def is_attached (elem, root):
+    """ Check if elem is still in the tree below root. """
+
+    while elem is not None:
+        if elem is root:
+            return True
+        elem = elem.getparent ()
+    return False
+
+
+class HTMLCleaner (object):
+    """ A list of rules to apply to a HTML tree. """
+
+    def __init__ (self):
+        self.rules = []
+        self.rules_by_tag = {}
+        self.rules_by_class = {}
+        self.rules_for_all = []
+
+
+    def add_rule (self, func, tags = None, classes = None):
+        """ Add a rule. Rules run in the order they were added. """
+
+        rule = Rule (func, tags, classes)
+        n = len (self.rules)
+        self.rules.append (rule)
+
+        if rule.match_all:
+            self.rules_for_all.append (n)
+        for tag in rule.tags:
+            self.rules_by_tag.setdefault (tag, []).append (n)
+        for class_ in rule.classes:
+            self.rules_by_class.setdefault (class_, []).append (n)
+
+
+    def run (self, xhtml):
+        """ Apply all rules to xhtml. """
+
+        matches = [[] for dummy_rule in self.rules]
+        root = xhtml.getroot () if hasattr (xhtml, 'getroot') else xhtml
+
+        for elem in xhtml.iter ():
+            for n in self.rules_for_all:
+                matches[n].append (elem)
+
+            if not isinstance (elem.tag, basestring):
+                # comments, processing instructions etc.
+                continue
+
+            wanted = self.rules_by_tag.get (elem.tag, ())
+            classes = elem.get ('class')
+            if classes and self.rules_by_class:
+                wanted = set (wanted)
+                for class_ in classes.split ():
+                    wanted.update (self.rules_by_class.get (class_, ()))
+
+            for n in wanted:
+                matches[n].append (elem)
+
+        for rule, elems in zip (self.rules, matches):
+            debug ("HTMLCleaner: %s on %d elements" % (
+                getattr (rule.func, '__name__', 'rule'), len (elems)))
+            for elem in elems:
+                if not is_attached (elem, root):
+                    # dropped by an earlier rule
+                    continue
+                rule.func (elem)
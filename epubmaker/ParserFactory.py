@@ -15,12 +15,18 @@ from __future__ import with_statement
 
 import os.path
 import urllib
+import urlparse
+import threading
+import StringIO
+from multiprocessing.pool import ThreadPool
 
 from pkg_resources import resource_listdir # pylint: disable=E0611
 
 from epubmaker.mydocutils import broken
 from epubmaker.lib.Logger import debug, error
 from epubmaker.lib.MediaTypes import mediatypes
+from epubmaker.lib import HTTPPool
+from epubmaker.lib import ArchiveURL
 from epubmaker.Version import VERSION
 from epubmaker.CommonOptions import Options
 
@@ -30,9 +36,22 @@ class AppURLopener (urllib.FancyURLopener):
     version = "ebookmaker/%s" % VERSION
 
 urllib._urlopener = AppURLopener ()
+HTTPPool.user_agent = AppURLopener.version
+
+MAX_CONNECTIONS_PER_HOST = 4
+
+# max. number of downloads started but not yet picked up by create ()
+MAX_PREFETCHED = 64
+
+# check the memory budget of the parser cache every n parser creations
+BUDGET_CHECK_INTERVAL = 16
 
 parser_modules = {}
 
+fetch_pool = None       # thread pool for prefetching
+host_semaphores = {}    # netloc -> semaphore limiting connections to host
+host_semaphores_lock = threading.Lock ()
+
 def load_parsers ():
     """ See what types we can parse. """
 
@@ -55,6 +74,114 @@ def unload_parsers ():
         del parser_modules[k]
     
 
+def open_url (url):
+    """ Open url.
+
+    http urls go thru the connection pool, unless we have to use a
+    proxy.  zip: and tar: urls are read from the archive.
+
+    """
+
+    if ArchiveURL.is_archive_url (url):
+        return ArchiveURL.urlopen (url)
+
+    if options.config.PROXIES is None and (
+        url.startswith ('http:') or url.startswith ('https:')):
+        return HTTPPool.urlopen (url)
+    return urllib.urlopen (url, proxies = options.config.PROXIES)
+
+
+class LazyURL (object):
+    """ Stands in for the file object returned by urllib.urlopen ().
+
+    Knows the final url and the headers, but opens the url only when
+    somebody reads from it.  So we don't hold thousands of open files
+    or sockets while spidering.
+
+    """
+
+    def __init__ (self, url, headers):
+        self.url = url
+        self.headers = headers
+        self.fp = None
+
+
+    def geturl (self):
+        """ Return the final url. """
+        return self.url
+
+
+    def info (self):
+        """ Return the headers. """
+        return self.headers
+
+
+    def read (self, *args):
+        """ Open the url and read from it. """
+        if self.fp is None:
+            self.fp = open_url (self.url)
+        return self.fp.read (*args)
+
+
+    def close (self):
+        """ Close the url if it is open. Reading opens it again. """
+        if self.fp is not None:
+            self.fp.close ()
+            self.fp = None
+
+
+def open_url_lazy (url):
+    """ Find the final url and the headers of url without keeping it open. """
+
+    if ArchiveURL.is_archive_url (url):
+        return LazyURL (url, ArchiveURL.info (url))
+
+    if options.config.PROXIES is None and (
+        url.startswith ('http:') or url.startswith ('https:')):
+        final_url, status, msg = HTTPPool.head (url)
+        if status < 400:
+            return LazyURL (final_url, msg)
+        if status in (404, 410):
+            raise IOError ('http error', status, msg)
+        # server does not like HEAD, do a GET instead.
+        # The pool reads the whole body, so this holds no socket.
+        return HTTPPool.urlopen (url)
+
+    # local files and proxied urls
+    fp = urllib.urlopen (url, proxies = options.config.PROXIES)
+    fp.close ()
+    return LazyURL (fp.geturl (), fp.info ())
+
+
+def get_host_semaphore (url):
+    """ Get the semaphore that limits connections to the host of url. """
+
+    netloc = urlparse.urlparse (url).netloc
+    with host_semaphores_lock:
+        if netloc not in host_semaphores:
+            host_semaphores[netloc] = threading.BoundedSemaphore (MAX_CONNECTIONS_PER_HOST)
+        return host_semaphores[netloc]
+
+
+def fetch (url):
+    """ Download url. Runs in a pool thread.
+
+    Returns a file-like object with the whole body in memory that
+    behaves like the one returned by urllib.urlopen ().
+
+    """
+
+    with get_host_semaphore (url):
+        debug ("Prefetching %s ..." % url)
+        fp = open_url (url)
+        try:
+            data = fp.read ()
+            return urllib.addinfourl (StringIO.StringIO (data), fp.info (), fp.geturl ())
+        finally:
+            fp.close ()
+
+
+
 class ParserFactory (object):
     """ A factory and a cache for parsers.
 
@@ -63,6 +190,75 @@ class ParserFactory (object):
     """
 
     parsers = {} # cache: parsers[url] = parser
+    spilled = set () # parsers that may have a spill file
+    prefetched = {} # prefetched[url] = AsyncResult
+    tick = 0 # LRU clock
+
+    @classmethod
+    def prefetch (cls, urls):
+        """ Start downloading urls in the background.
+
+        Only http urls are prefetched.  create () picks up the
+        results.  At most MAX_PREFETCHED downloads are outstanding,
+        urls beyond that are fetched when they are requested.
+
+        """
+
+        global fetch_pool
+
+        threads = getattr (options, 'fetch_threads', 0)
+        if not threads:
+            return
+
+        for url in urls:
+            if url in cls.parsers or url in cls.prefetched:
+                continue
+            if not (url.startswith ('http:') or url.startswith ('https:')):
+                continue
+            if len (cls.prefetched) >= MAX_PREFETCHED:
+                break
+            if fetch_pool is None:
+                fetch_pool = ThreadPool (threads)
+            cls.prefetched[url] = fetch_pool.apply_async (fetch, (url, ))
+
+
+    @classmethod
+    def urlopen (cls, url):
+        """ Open url. Use prefetched data if we have it.
+
+        Otherwise the url is opened only when the parser reads it.
+
+        """
+
+        result = cls.prefetched.pop (url, None)
+        if result is not None:
+            return result.get () # re-raises the IOError if fetch failed
+        return open_url_lazy (url)
+
+
+    @classmethod
+    def prefetched_footprint (cls):
+        """ Return the bytes held by finished prefetches. """
+
+        total = 0
+        for result in cls.prefetched.itervalues ():
+            if result.ready () and result.successful ():
+                total += len (result.get ().fp.getvalue ())
+        return total
+
+
+    @classmethod
+    def drop_prefetched (cls):
+        """ Drop all prefetched data nobody asked for.
+
+        Pending downloads finish and get dropped.
+
+        """
+
+        if cls.prefetched:
+            debug ("Dropping %d unused prefetches" % len (cls.prefetched))
+        cls.prefetched = {}
+
     
     @staticmethod
     def get (mediatype):
@@ -79,9 +275,12 @@ class ParserFactory (object):
 
         # debug ("Need parser for %s" % url)
 
+        cls.tick += 1
+
         if url in cls.parsers:
             # debug ("... reusing parser for %s" % url)
             # reuse same parser, maybe already filled with data
+            cls.parsers[url].last_used = cls.tick
             return cls.parsers[url]
 
         orig_url = url
@@ -95,7 +294,7 @@ class ParserFactory (object):
             parser.url = url
             parser.broken_image ()
         else:
-            fp = urllib.urlopen (url, proxies = options.config.PROXIES)
+            fp = cls.urlopen (url)
             url = fp.geturl ()
 
             if url != orig_url:
@@ -103,6 +302,7 @@ class ParserFactory (object):
                 if url in cls.parsers:
                     # debug ("... reusing parser for %s" % url)
                     # reuse same parser, maybe already filled with data
+                    cls.parsers[url].last_used = cls.tick
                     return cls.parsers[url]
 
             # ok. so we have to create a new parser
@@ -135,17 +335,83 @@ class ParserFactory (object):
 
         cls.parsers[parser.url] = parser
         cls.parsers[orig_url] = parser
+        parser.last_used = cls.tick
+
+        if cls.tick % BUDGET_CHECK_INTERVAL == 0:
+            cls.enforce_budget ()
 
         return parser
+
+
+    @classmethod
+    def enforce_budget (cls):
+        """ Keep the memory used by cached parsers below the budget.
+
+        Prefetched data counts too.  First drop prefetched data, then
+        spill image data to disk, then drop parsers that have
+        already been written to an output, then drop the least
+        recently used parsers.  A dropped parser still referenced
+        elsewhere (eg. by a spider) stays alive, it just gets
+        recreated on the next request.
+
+        """
+
+        budget = getattr (options, 'parser_cache_size', 0) * 1024 * 1024
+        if not budget:
+            return
+
+        parsers = dict ([(id (p), p) for p in cls.parsers.itervalues ()]).values ()
+        prefetched = cls.prefetched_footprint ()
+        total = sum ([p.footprint () for p in parsers]) + prefetched
+        if total <= budget:
+            return
+
+        debug ("Parser cache uses %d bytes of %d, evicting ..." % (total, budget))
+
+        if prefetched:
+            cls.drop_prefetched ()
+            total -= prefetched
+
+        parsers.sort (key = lambda p: p.last_used)
+
+        for p in parsers:
+            if total <= budget:
+                return
+            if hasattr (p, 'spill'):
+                total -= p.spill ()
+                cls.spilled.add (p)
+
+        for evictable in (lambda p: p.serialized, lambda p: True):
+            for p in parsers:
+                if total <= budget:
+                    return
+                if evictable (p) and p.footprint ():
+                    total -= p.footprint ()
+                    cls.evict (p)
+
+
+    @classmethod
+    def evict (cls, parser):
+        """ Remove parser from the cache. """
+
+        debug ("Evicting parser for %s" % parser.url)
+        parser.unmap ()
+        for url in [url for url, p in cls.parsers.iteritems () if p is parser]:
+            del cls.parsers[url]
     
 
     @classmethod
     def clear (cls):
         """ Clear parser cache to free memory. """
 
-        # debug: kill refs
-        for dummy_url, parser in cls.parsers.items ():
-            del parser
-            
+        # close mapped files and remove spill files now, not when
+        # the last reference goes
+        for parser in cls.spilled.union (cls.parsers.values ()):
+            parser.unmap ()
+            if hasattr (parser, 'unspill'):
+                parser.unspill ()
+
         cls.parsers = {}
+        cls.spilled = set ()
+        cls.drop_prefetched ()
 
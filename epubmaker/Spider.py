@@ -15,8 +15,12 @@ Rudimentary Web Spider
 
 from __future__ import with_statement
 
+import os
+import re
 import urlparse
 import fnmatch
+import mimetypes
+import collections
 
 from epubmaker.lib import MediaTypes
 import epubmaker.lib.GutenbergGlobals as gg
@@ -27,16 +31,191 @@ from epubmaker import ParserFactory
 
 COVERPAGE_MIN_AREA = 200 * 200
 
+
+class LinkGraph (object):
+    """ The link graph of the book being built.
+
+    Every output format crawls the book with a spider of its own, but
+    most of the work is the same for all of them.  The first spider
+    to visit a document records its links here and later spiders
+    replay them without asking the parser again.  The results of the
+    topological sort are kept too.  Every spider still applies its
+    own crawl policy, so each output format gets its own view of the
+    graph.
+
+    Cleared at the start of every book.
+
+    """
+
+    links = {}    # (url, want_images) -> list of (url, attr)
+    orders = {}   # tuple of rel=next pairs -> dict url -> order
+
+    @classmethod
+    def iterlinks (cls, parser, want_images):
+        """ Return the links of parser. Ask the parser only once. """
+
+        if not parser.links_depend_on_want_images:
+            want_images = None
+        key = (parser.url, want_images)
+        if key not in cls.links:
+            debug ("Requesting iterlinks for: %s ..." % parser.url)
+            cls.links[key] = list (parser.iterlinks ())
+        return cls.links[key]
+
+
+    @classmethod
+    def clear (cls):
+        """ Forget the graph. """
+
+        cls.links.clear ()
+        cls.orders.clear ()
+
+
+def compile_globs (patterns, normcase = False):
+    """ Compile a list of shell-style patterns into one regex.
+
+    Returns a function that returns a match if any of the patterns
+    matches the whole string.  With normcase the patterns are
+    normalized like fnmatch.fnmatch () does, the caller must
+    normalize the string.
+
+    """
+
+    if normcase:
+        patterns = [os.path.normcase (pattern) for pattern in patterns]
+    regex = '|'.join (['(?:%s)' % fnmatch.translate (pattern) for pattern in patterns])
+    return re.compile (regex or '(?!)').match
+
+
+class CrawlPolicy (object):
+    """ Decides which urls and mediatypes a spider follows.
+
+    The include and exclude patterns of each kind are compiled into
+    one regex.  The decisions about urls and mediatypes are remembered
+    for the lifetime of the policy, ie. of one spider.
+
+    Subclass this to make a custom spider and set the policy_class of
+    the spider.
+
+    """
+
+    def __init__ (self, options):
+        self.options = options
+        self.include = compile_globs (options.include)
+        self.exclude = compile_globs (options.exclude)
+        self.include_mediatypes = compile_globs (options.include_mediatypes, True)
+        self.exclude_mediatypes = compile_globs (options.exclude_mediatypes, True)
+        self.urls = {}       # url -> result of is_included ()
+        self.mediatypes = {} # mediatype -> (included, excluded)
+        self.included_mediatypes = set ()
+        self.excluded_mediatypes = set ()
+
+
+    def is_included (self, url):
+        """ Return True if url passes the include and exclude patterns. """
+
+        if url not in self.urls:
+            self.urls[url] = self.match_url (url)
+        return self.urls[url]
+
+
+    def match_url (self, url):
+        """ Match url against the include and exclude patterns. """
+
+        included = bool (self.include (url))
+        excluded = bool (self.exclude (url))
+
+        if included and not excluded:
+            if self.options.local_files_only:
+                if url.startswith('http:') or url.startswith('https:'):
+                    return 0
+                else:
+                    return 1 
+            return 1
+
+        if excluded:
+            debug ("Dropping excluded %s" % url)
+        if not included:
+            debug ("Dropping not included %s" % url)
+        return 0
+
+
+    def classify_mediatype (self, mediatype):
+        """ Return (included, excluded) for mediatype. """
+
+        if mediatype not in self.mediatypes:
+            normalized = os.path.normcase (mediatype)
+            self.mediatypes[mediatype] = (bool (self.include_mediatypes (normalized)),
+                                          bool (self.exclude_mediatypes (normalized)))
+        return self.mediatypes[mediatype]
+
+
+    def match_mediatype (self, mediatype):
+        """ Return True if mediatype passes the include and exclude patterns.
+
+        Unlike is_included_mediatype () this has no side effects.
+
+        """
+
+        included, excluded = self.classify_mediatype (mediatype)
+        return included and not excluded
+
+
+    def is_included_mediatype (self, mediatype):
+        """ Return True if this document is eligible. """
+
+        included, excluded = self.classify_mediatype (mediatype)
+
+        if included and not excluded:
+            self.included_mediatypes.add (mediatype)
+            return 1
+
+        if mediatype not in self.excluded_mediatypes:
+            if excluded:
+                debug ("Dropping excluded mediatype %s" % mediatype)
+            if not included:
+                debug ("Dropping not included mediatype %s" % mediatype)
+            
+        self.excluded_mediatypes.add (mediatype)
+        return 0
+
+
+    def has_seen_images (self):
+        """ Return True if we have encountered images. """
+
+        return bool (MediaTypes.IMAGE_MEDIATYPES &
+                       (self.included_mediatypes | self.excluded_mediatypes))
+
+
+    def is_wanted_doc (self, parser):
+        """ Return True if we ought to parse this content document.
+
+        Override this in custom policies.
+
+        """
+        return self.is_included_mediatype (parser.mediatype)
+
+
+    def is_wanted_aux (self, parser):
+        """ Return True if we ought to parse this image or aux file.
+
+        Override this in custom policies.
+
+        """
+        return self.is_included_mediatype (parser.mediatype)
+
+
 class Spider (object):
     """ A very rudimentary web spider. """
 
+    policy_class = CrawlPolicy
+
     def __init__ (self):
         self.options = None
+        self.policy = None
         self.parsed_urls = set ()
         self.enqueued_urls = set ()
-        self.included_mediatypes = set ()
-        self.excluded_mediatypes = set ()
-        self.queue = []
+        self.queue = collections.deque ()
         self.parsers = []
         self.next = [] # for a topological sort
         self.redirection_map = {}
@@ -52,6 +231,7 @@ class Spider (object):
         """
 
         self.options = options
+        self.policy = self.policy_class (options)
 
         for rewrite in self.options.rewrite:
             from_, to = rewrite.split ('>')
@@ -65,7 +245,7 @@ class Spider (object):
         self.enqueue (url, 0, attribs)
 
         while self.queue:
-            (url, depth, attribs) = self.queue.pop (0)
+            (url, depth, attribs) = self.queue.popleft ()
 
             url = self.redirect (url)
             if url in self.parsed_urls:
@@ -96,9 +276,10 @@ class Spider (object):
             depth += 1
 
             # look for links in just parsed document
-            debug ("Requesting iterlinks for: %s ..." % url)
+            links = LinkGraph.iterlinks (parser, options.want_images)
+            self.prefetch (links, depth)
 
-            for (url, attr) in parser.iterlinks ():
+            for (url, attr) in links:
                 # debug ("*** link: %s ..." % url)
 
                 url = urlparse.urldefrag (url)[0]
@@ -140,6 +321,9 @@ class Spider (object):
                     continue
                     
         debug ("End of retrieval")
+
+        # links we prefetched but did not follow
+        ParserFactory.ParserFactory.drop_prefetched ()
         
         # rewrite redirected urls
         if self.redirection_map:
@@ -151,10 +335,14 @@ class Spider (object):
             self.next = map (lambda x: (self.redirect(x[0]), self.redirect(x[1])), self.next)
 
             try:
-                d = {}
-                for order, url in enumerate (gg.topological_sort (self.next)):
-                    d[url] = order
-                    debug ("%s order %d" % (url, order))
+                key = tuple (self.next)
+                if key not in LinkGraph.orders:
+                    d = {}
+                    for order, url in enumerate (gg.topological_sort (self.next)):
+                        d[url] = order
+                        debug ("%s order %d" % (url, order))
+                    LinkGraph.orders[key] = d
+                d = LinkGraph.orders[key]
                 for parser in self.parsers:
                     parser.order = d.get (parser.url, 999999)
                 self.parsers.sort (key = lambda p: p.order)
@@ -163,6 +351,39 @@ class Spider (object):
                 pass
 
 
+    def prefetch (self, links, depth):
+        """ Start downloading the links we are probably going to follow.
+
+        This only starts the downloads. The links are still processed
+        in BFS order by the caller.
+
+        """
+
+        urls = []
+        for (url, attr) in links:
+            url = self.redirect (urlparse.urldefrag (url)[0])
+            if url in self.enqueued_urls:
+                continue
+
+            tag = attr.get ('tag', '')
+            rel = attr.get ('rel', '').lower ()
+            is_aux = (tag in (NS.xhtml.img, NS.xhtml.object) or
+                      (tag == NS.xhtml.link and ('stylesheet' in rel or rel == 'coverpage')))
+
+            if not is_aux:
+                if self.options.max_depth and depth >= self.options.max_depth:
+                    continue
+                if not self.is_included (url):
+                    continue
+
+            mediatype = attr.get ('type') or mimetypes.types_map.get (
+                os.path.splitext (urlparse.urlparse (url).path)[1].lower ())
+            if mediatype and self.match_mediatype (mediatype):
+                urls.append (url)
+
+        ParserFactory.ParserFactory.prefetch (urls)
+
+
     def add_redirection (self, parser):
         """ Remember this redirection. """
         if parser.orig_url != parser.url:
@@ -224,50 +445,26 @@ class Spider (object):
     def is_included (self, url):
         """ Return True if this document is eligible. """
 
-        included = any (map (lambda x: fnmatch.fnmatchcase (url, x), self.options.include))
-        excluded = any (map (lambda x: fnmatch.fnmatchcase (url, x), self.options.exclude))
-
-        if included and not excluded:
-            if self.options.local_files_only:
-                if url.startswith('http:') or url.startswith('https:'):
-                    return 0
-                else:
-                    return 1 
-            return 1
-
-        if excluded:
-            debug ("Dropping excluded %s" % url)
-        if not included:
-            debug ("Dropping not included %s" % url)
-        return 0
+        return self.policy.is_included (url)
             
 
-    def is_included_mediatype (self, mediatype):
-        """ Return True if this document is eligible. """
+    def match_mediatype (self, mediatype):
+        """ Return True if mediatype passes the include and exclude patterns.
 
-        included = any (map (lambda pattern: fnmatch.fnmatch (mediatype, pattern),
-                             self.options.include_mediatypes))
-        excluded = any (map (lambda pattern: fnmatch.fnmatch (mediatype, pattern),
-                             self.options.exclude_mediatypes))
+        Unlike is_included_mediatype () this has no side effects.
 
-        if included and not excluded:
-            self.included_mediatypes.add (mediatype)
-            return 1
+        """
+        return self.policy.match_mediatype (mediatype)
 
-        if excluded:
-            debug ("Dropping excluded mediatype %s" % mediatype)
-        if not included:
-            debug ("Dropping not included mediatype %s" % mediatype)
-            
-        self.excluded_mediatypes.add (mediatype)
-        return 0
+
+    def is_included_mediatype (self, mediatype):
+        """ Return True if this document is eligible. """
+        return self.policy.is_included_mediatype (mediatype)
             
 
     def has_seen_images (self):
         """ Return True if the spider has encountered images. """
-
-        return bool (MediaTypes.IMAGE_MEDIATYPES &
-                       (self.included_mediatypes | self.excluded_mediatypes))
+        return self.policy is not None and self.policy.has_seen_images ()
 
         
     def dict_urls_mediatypes (self):
@@ -278,18 +475,16 @@ class Spider (object):
     def is_wanted_doc (self, parser):
         """ Return True if we ought to parse this content document.
 
-        Override this in custom spiders.
+        Override CrawlPolicy.is_wanted_doc () in custom policies.
 
         """
-        return self.is_included_mediatype (parser.mediatype)
+        return self.policy.is_wanted_doc (parser)
 
 
     def is_wanted_aux (self, parser):
         """ Return True if we ought to parse this image or aux file.
 
-        Override this in custom spiders.
+        Override CrawlPolicy.is_wanted_aux () in custom policies.
 
         """
-        return self.is_included_mediatype (parser.mediatype)
-
-
+        return self.policy.is_wanted_aux (parser)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+ArchiveURL.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Read files straight out of zip and tar archives.
+
+An archive url names one member of an archive file:
+
+  zip:///path/to/1234-h.zip!/1234-h/1234-h.htm
+  tar:///path/to/1234.tar.gz!/1234/1234.rst
+
+The part before '!/' is the path of the archive, the part after it
+is the name of the member.  The schemes are registered with urlparse,
+so relative links resolve to other members of the same archive.
+
+An archive is opened when the first of its members is read and stays
+open until close () is called, so its directory is read only once.
+Members are read into memory, never into temporary files.
+
+"""
+
+from __future__ import with_statement
+
+import mimetools
+import mimetypes
+import posixpath
+import StringIO
+import tarfile
+import threading
+import urllib
+import urlparse
+import zipfile
+
+from epubmaker.lib.Logger import debug
+
+SCHEMES = ('zip', 'tar')
+
+for _scheme in SCHEMES:
+    if _scheme not in urlparse.uses_relative:
+        urlparse.uses_relative.append (_scheme)
+    if _scheme not in urlparse.uses_netloc:
+        urlparse.uses_netloc.append (_scheme)
+
+archives = {} # (scheme, filename) -> open archive
+archives_lock = threading.Lock ()
+
+
+def is_archive_url (url):
+    """ Return True if url points into an archive. """
+    return urlparse.urlsplit (url).scheme in SCHEMES
+
+
+def split_url (url):
+    """ Split an archive url into (scheme, archive filename, member name). """
+
+    scheme, dummy_netloc, path, dummy_query, dummy_fragment = urlparse.urlsplit (url)
+    archive, sep, member = path.partition ('!/')
+    if scheme not in SCHEMES or not sep or not member:
+        raise IOError ('archive error', 'not an archive url', url)
+    return (scheme, urllib.url2pathname (archive),
+            posixpath.normpath (urllib.unquote (member)))
+
+
+class ZipArchive (object):
+    """ An open zip file. """
+
+    def __init__ (self, filename):
+        self.zip = zipfile.ZipFile (filename)
+        self.lock = threading.Lock ()
+
+
+    def size (self, member):
+        """ Return the size of member. Raise KeyError if there is none. """
+        return self.zip.getinfo (member).file_size
+
+
+    def read (self, member):
+        """ Return the contents of member. """
+        with self.lock:
+            return self.zip.read (member)
+
+
+    def close (self):
+        """ Close the zip file. """
+        self.zip.close ()
+
+
+class TarArchive (object):
+    """ An open tar file, maybe compressed. """
+
+    def __init__ (self, filename):
+        self.tar = tarfile.open (filename)
+        self.members = dict ([(posixpath.normpath (m.name.lstrip ('/')), m)
+                              for m in self.tar.getmembers () if m.isfile ()])
+        self.lock = threading.Lock ()
+
+
+    def size (self, member):
+        """ Return the size of member. Raise KeyError if there is none. """
+        return self.members[member].size
+
+
+    def read (self, member):
+        """ Return the contents of member. """
+        with self.lock:
+            return self.tar.extractfile (self.members[member]).read ()
+
+
+    def close (self):
+        """ Close the tar file. """
+        self.tar.close ()
+
+
+ARCHIVE_CLASSES = {
+    'zip': ZipArchive,
+    'tar': TarArchive,
+    }
+
+
+def get_archive (scheme, filename):
+    """ Get the open archive. Open it if needed. """
+
+    with archives_lock:
+        key = (scheme, filename)
+        if key not in archives:
+            debug ("Opening archive %s" % filename)
+            try:
+                archives[key] = ARCHIVE_CLASSES[scheme] (filename)
+            except (zipfile.BadZipfile, tarfile.TarError), what:
+                raise IOError ('archive error', filename, what)
+        return archives[key]
+
+
+def info (url):
+    """ Return the headers of the member at url, without reading it. """
+
+    scheme, filename, member = split_url (url)
+    try:
+        size = get_archive (scheme, filename).size (member)
+    except KeyError:
+        raise IOError ('archive error', 'no such member', url)
+
+    mediatype = mimetypes.guess_type (member)[0] or 'application/octet-stream'
+    return mimetools.Message (StringIO.StringIO (
+        'Content-Type: %s\nContent-Length: %d\n\n' % (mediatype, size)))
+
+
+def urlopen (url):
+    """ Open the member at url.
+
+    Returns the same kind of file object as urllib.urlopen ().
+
+    """
+
+    headers = info (url)
+    scheme, filename, member = split_url (url)
+    data = get_archive (scheme, filename).read (member)
+    return urllib.addinfourl (StringIO.StringIO (data), headers, url)
+
+
+def close ():
+    """ Close all open archives. """
+
+    with archives_lock:
+        for archive in archives.itervalues ():
+            archive.close ()
+        archives.clear ()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+Cache.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+A content-addressed on-disk cache for expensive intermediate results
+(parsed doctrees, tidied html, ...).
+
+Entries live in namespaces (subdirectories).  The key is a hash of
+everything that went into producing the entry.  Entries are written
+atomically, so concurrent worker processes may share one cache.  When
+the cache grows over its size limit the least recently used entries
+are removed.
+
+Usage:
+
+    Cache.setup (cachedir, max_size)
+    key = Cache.make_key (source, settings, VERSION)
+    data = Cache.get ('namespace', key)
+    if data is None:
+        data = expensive ()
+        Cache.put ('namespace', key, data)
+
+"""
+
+import os
+import mmap
+import hashlib
+import tempfile
+import cPickle as pickle
+
+from epubmaker.lib.Logger import debug, warn
+
+DEFAULT_CACHE_DIR = '~/.cache/epubmaker'
+DEFAULT_CACHE_SIZE = 1024 # MB
+
+# keep evicting until the cache is this fraction of its maximum size
+LOW_WATER_MARK = 0.8
+
+cache = None # the current Cache instance, None if caching is disabled
+
+
+def make_key (*parts):
+    """ Make a cache key out of parts.
+
+    Parts may be strings, mapped files, unicode strings or anything
+    with a stable repr ().
+
+    """
+
+    h = hashlib.sha1 ()
+    for part in parts:
+        if isinstance (part, unicode):
+            part = part.encode ('utf-8')
+        elif not isinstance (part, (str, mmap.mmap)):
+            part = repr (part)
+        h.update ('%d:' % len (part))
+        h.update (part)
+    return h.hexdigest ()
+
+
+class Cache (object):
+    """ A directory of cache entries. """
+
+    def __init__ (self, cachedir, max_size):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.written = 0
+
+
+    def path (self, namespace, key):
+        """ Return the filename of an entry. """
+        return os.path.join (self.cachedir, namespace, key[:2], key)
+
+
+    def get (self, namespace, key):
+        """ Return the data stored under key or None. """
+
+        filename = self.path (namespace, key)
+        try:
+            with open (filename, 'rb') as fp:
+                data = fp.read ()
+            os.utime (filename, None) # mark as recently used
+        except (IOError, OSError):
+            return None
+
+        debug ("Cache hit: %s/%s" % (namespace, key))
+        return data
+
+
+    def put (self, namespace, key, data):
+        """ Store data under key. """
+
+        filename = self.path (namespace, key)
+        dirname = os.path.dirname (filename)
+        try:
+            if not os.path.isdir (dirname):
+                os.makedirs (dirname)
+            fd, tmpname = tempfile.mkstemp (dir = dirname)
+            with os.fdopen (fd, 'wb') as fp:
+                fp.write (data)
+            os.rename (tmpname, filename)
+        except (IOError, OSError), what:
+            warn ("Cannot write cache entry %s: %s" % (filename, what))
+            return
+
+        self.written += len (data)
+        if self.written > self.max_size / 16:
+            self.evict ()
+
+
+    def evict (self):
+        """ Remove least recently used entries until the cache is small enough. """
+
+        self.written = 0
+
+        entries = []
+        total = 0
+        for dirpath, dummy_dirnames, filenames in os.walk (self.cachedir):
+            for filename in filenames:
+                filename = os.path.join (dirpath, filename)
+                try:
+                    st = os.stat (filename)
+                except OSError:
+                    continue
+                entries.append ((st.st_mtime, st.st_size, filename))
+                total += st.st_size
+
+        if total <= self.max_size:
+            return
+
+        debug ("Cache size %d exceeds %d, evicting ..." % (total, self.max_size))
+
+        entries.sort ()
+        for dummy_mtime, size, filename in entries:
+            if total <= self.max_size * LOW_WATER_MARK:
+                break
+            try:
+                os.remove (filename)
+                total -= size
+            except OSError:
+                pass
+
+
+def setup (cachedir, max_size_mb = DEFAULT_CACHE_SIZE):
+    """ Configure the cache. cachedir == None disables caching. """
+
+    global cache
+
+    if cachedir is None:
+        cache = None
+        return
+
+    cachedir = os.path.abspath (os.path.expanduser (cachedir))
+    max_size = max_size_mb * 1024 * 1024
+    if cache is None or cache.cachedir != cachedir or cache.max_size != max_size:
+        cache = Cache (cachedir, max_size)
+
+
+def get (namespace, key):
+    """ Return the data stored under key or None. """
+
+    if cache is None:
+        return None
+    return cache.get (namespace, key)
+
+
+def put (namespace, key, data):
+    """ Store data under key. """
+
+    if cache is not None:
+        cache.put (namespace, key, data)
+
+
+def get_pickle (namespace, key):
+    """ Return the object stored under key or None. """
+
+    data = get (namespace, key)
+    if data is None:
+        return None
+    try:
+        return pickle.loads (data)
+    except (pickle.UnpicklingError, EOFError, ImportError,
+            AttributeError, TypeError, ValueError), what:
+        warn ("Cannot unpickle cache entry %s/%s: %s" % (namespace, key, what))
+        return None
+
+
+def put_pickle (namespace, key, obj):
+    """ Store obj under key. Return False if obj could not be pickled. """
+
+    if cache is None:
+        return False
+    try:
+        data = pickle.dumps (obj, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError, RuntimeError), what:
+        debug ("Cannot pickle for cache %s/%s: %s" % (namespace, key, what))
+        return False
+    put (namespace, key, data)
+    return True
@@ -215,6 +215,7 @@ class DublinCore (object):
         self.categories = []
         self.dcmitypes = [] # similar to categories but based on the DCMIType vocabulary
         self.release_date = None
+        self.modified = None # fixed timestamp for reproducible builds
         self.edition = None
         self.contents = None
         self.encoding = None
@@ -350,7 +351,7 @@ class DublinCore (object):
             lit ('dcterms:language', language.id, 'dcterms:RFC4646')
 
         lit ('dcterms:modified', 
-             datetime.datetime.now (gg.UTC ()).isoformat (), 
+             (self.modified or datetime.datetime.now (gg.UTC ())).isoformat (), 
              'dcterms:W3CDTF')
 
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+ExternalTools.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Limit the number of external tools (tidy, groff, xelatex, kindlegen,
+epubcheck) running at the same time across all worker processes.
+
+Usage:
+
+    with ExternalTools.slot ():
+        proc = subprocess.Popen (...)
+        proc.communicate ()
+
+"""
+
+import multiprocessing
+
+semaphore = None     # shared by all worker processes
+holders = None       # holders[i] = no. of slots held by worker i
+worker_index = None  # index of this worker process, None in the master
+
+
+def setup (max_tools, workers):
+    """ Allow max_tools concurrent tools among workers processes.
+
+    Must be called in the master before forking the workers.
+    max_tools == 0 means no limit.
+
+    """
+
+    global semaphore, holders
+
+    semaphore = None
+    holders = None
+    if max_tools > 0:
+        semaphore = multiprocessing.BoundedSemaphore (max_tools)
+        holders = multiprocessing.Array ('i', max (workers, 1))
+
+
+def release_worker (index):
+    """ Release all slots held by a worker we had to kill. """
+
+    if holders is not None:
+        while holders[index] > 0:
+            holders[index] -= 1
+            semaphore.release ()
+
+
+class slot (object):
+    """ Context manager that holds a slot while an external tool runs. """
+
+    def __enter__ (self):
+        if semaphore is not None:
+            semaphore.acquire ()
+            if worker_index is not None:
+                holders[worker_index] += 1
+        return self
+
+
+    def __exit__ (self, dummy_type, dummy_value, dummy_traceback):
+        if semaphore is not None:
+            if worker_index is not None:
+                holders[worker_index] -= 1
+            semaphore.release ()
+        return False
+
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+HTTPPool.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+HTTP fetching with persistent connections and conditional requests.
+
+Connections are kept open and reused for further requests to the same
+host.  Responses that carry an ETag or a Last-Modified header are
+stored in the 'http' namespace of the Cache.  The next request for the
+same url is sent as a conditional GET, and a 304 response is answered
+from the Cache.
+
+urlopen () returns the same kind of file object as urllib.urlopen ().
+
+"""
+
+from __future__ import with_statement
+
+import httplib
+import socket
+import threading
+import urllib
+import urlparse
+import StringIO
+
+from epubmaker.lib.Logger import debug
+from epubmaker.lib import Cache
+
+MAX_REDIRECTS = 10
+TIMEOUT = 60 # seconds
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+user_agent = 'ebookmaker'
+
+
+class HTTPPool (object):
+    """ A pool of persistent HTTP connections. """
+
+    def __init__ (self):
+        self.idle = {} # (scheme, netloc) -> list of idle connections
+        self.lock = threading.Lock ()
+
+
+    def get_connection (self, scheme, netloc):
+        """ Get an idle connection or make a new one.
+
+        Returns (connection, reused).
+
+        """
+
+        with self.lock:
+            idle = self.idle.get ((scheme, netloc))
+            if idle:
+                return idle.pop (), True
+
+        if scheme == 'https':
+            return httplib.HTTPSConnection (netloc, timeout = TIMEOUT), False
+        return httplib.HTTPConnection (netloc, timeout = TIMEOUT), False
+
+
+    def put_connection (self, scheme, netloc, conn):
+        """ Return a connection to the pool. """
+
+        with self.lock:
+            self.idle.setdefault ((scheme, netloc), []).append (conn)
+
+
+    def request (self, url, headers, method = 'GET'):
+        """ Send a request.
+
+        Returns (status, reason, HTTPMessage, body).
+
+        """
+
+        scheme, netloc, path, query, dummy_fragment = urlparse.urlsplit (url)
+        path = urlparse.urlunsplit (('', '', path or '/', query, ''))
+
+        headers = dict (headers)
+        headers['User-Agent'] = user_agent
+
+        while True:
+            conn, reused = self.get_connection (scheme, netloc)
+            try:
+                conn.request (method, path, headers = headers)
+                response = conn.getresponse ()
+                body = response.read ()
+            except (httplib.HTTPException, socket.error), what:
+                conn.close ()
+                if reused:
+                    # the server probably closed the idle connection,
+                    # retry on a fresh one
+                    continue
+                raise IOError ('http error', what)
+
+            if response.will_close:
+                conn.close ()
+            else:
+                self.put_connection (scheme, netloc, conn)
+
+            return response.status, response.reason, response.msg, body
+
+
+    def head (self, url):
+        """ Get the headers of url. Follow redirects.
+
+        Returns (url, status, HTTPMessage).
+
+        """
+
+        for dummy_redirect in range (MAX_REDIRECTS):
+            status, dummy_reason, msg, dummy_body = self.request (url, {}, 'HEAD')
+
+            if status in REDIRECT_CODES and msg.getheader ('location'):
+                url = urlparse.urljoin (url, msg.getheader ('location'))
+                continue
+
+            return url, status, msg
+
+        raise IOError ('http error', 'too many redirects', url)
+
+
+    def urlopen (self, url):
+        """ Open url. Follow redirects. Use the cache. """
+
+        for dummy_redirect in range (MAX_REDIRECTS):
+            key = Cache.make_key (url)
+            cached = Cache.get_pickle ('http', key)
+
+            headers = {}
+            if cached is not None:
+                if cached.get ('etag'):
+                    headers['If-None-Match'] = cached['etag']
+                if cached.get ('last_modified'):
+                    headers['If-Modified-Since'] = cached['last_modified']
+
+            status, reason, msg, body = self.request (url, headers)
+
+            if status in REDIRECT_CODES and msg.getheader ('location'):
+                newurl = urlparse.urljoin (url, msg.getheader ('location'))
+                debug ("... %s redirected to %s" % (url, newurl))
+                url = newurl
+                continue
+
+            if status == 304 and cached is not None:
+                debug ("... %s not modified" % url)
+                msg = httplib.HTTPMessage (StringIO.StringIO (cached['headers']))
+                return urllib.addinfourl (
+                    StringIO.StringIO (cached['body']), msg, url, 200)
+
+            if status >= 400:
+                raise IOError ('http error', status, reason, msg)
+
+            etag = msg.getheader ('etag')
+            last_modified = msg.getheader ('last-modified')
+            if status == 200 and (etag or last_modified):
+                Cache.put_pickle ('http', key, {
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'headers': str (msg),
+                    'body': body,
+                    })
+
+            return urllib.addinfourl (StringIO.StringIO (body), msg, url, status)
+
+        raise IOError ('http error', 'too many redirects', url)
+
+
+pool = HTTPPool ()
+
+
+def urlopen (url):
+    """ Open url using the shared pool. """
+    return pool.urlopen (url)
+
+
+def head (url):
+    """ Get the headers of url using the shared pool. """
+    return pool.head (url)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+ParallelZip.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+A zip file that compresses its members in a pool of threads.
+
+zlib releases the GIL while it compresses, so threads are enough to
+deflate many members at once.  The compressed members are written to
+the zip file in the order they were added, so the result does not
+depend on which thread finished first.
+
+Only writing is supported.
+
+"""
+
+from __future__ import with_statement
+
+import os
+import time
+import zlib
+import zipfile
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# how many members per thread may wait to be written
+PENDING_PER_THREAD = 4
+
+# the earliest date a zip file can hold
+MIN_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def zip_date_time (dt):
+    """ Convert a datetime into a zip member date_time.
+
+    Returns None if dt is None.
+
+    """
+
+    if dt is None:
+        return None
+    return max (MIN_DATE_TIME, dt.timetuple ()[:6])
+
+
+def compress (data, compress_type):
+    """ Compress the data of one member. Return (crc, compressed data). """
+
+    crc = zlib.crc32 (data) & 0xffffffff
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj (
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = compressor.compress (data) + compressor.flush ()
+    return crc, data
+
+
+class ParallelZipFile (zipfile.ZipFile):
+    """ A write-only zip file that compresses members in parallel.
+
+    threads == 0 means one thread per cpu.  With only one thread
+    members are compressed in the calling thread.
+
+    If date_time is given, all members are stamped with it instead of
+    the current time or the time of the file, to make reproducible
+    zip files.
+
+    """
+
+    def __init__ (self, filename, compression = zipfile.ZIP_DEFLATED, threads = 0,
+                  date_time = None):
+        zipfile.ZipFile.__init__ (self, filename, 'w', compression)
+        self.threads = threads or multiprocessing.cpu_count ()
+        self.date_time = date_time
+        self.pool = None
+        self.pending = collections.deque () # (zinfo, file_size, async result)
+
+
+    def writestr (self, zinfo_or_arcname, bytes_, compress_type = None):
+        """ Add member to zip from bytes string. """
+
+        if isinstance (zinfo_or_arcname, zipfile.ZipInfo):
+            zinfo = zinfo_or_arcname
+        else:
+            zinfo = zipfile.ZipInfo (zinfo_or_arcname, time.localtime (time.time ())[:6])
+            zinfo.compress_type = self.compression
+            zinfo.external_attr = 0600 << 16
+        if compress_type is not None:
+            zinfo.compress_type = compress_type
+
+        if self.threads < 2:
+            self.write_compressed (zinfo, len (bytes_),
+                                   compress (bytes_, zinfo.compress_type))
+            return
+
+        if self.pool is None:
+            self.pool = ThreadPool (self.threads)
+
+        self.pending.append ((zinfo, len (bytes_), self.pool.apply_async (
+            compress, (bytes_, zinfo.compress_type))))
+        self.drain (self.threads * PENDING_PER_THREAD)
+
+
+    def write (self, filename, arcname = None, compress_type = None):
+        """ Add member to zip from file on disk. """
+
+        if os.path.isdir (filename):
+            self.flush ()
+            zipfile.ZipFile.write (self, filename, arcname, compress_type)
+            return
+
+        st = os.stat (filename)
+        if arcname is None:
+            arcname = filename
+        arcname = os.path.normpath (os.path.splitdrive (arcname)[1]).lstrip (os.sep)
+
+        zinfo = zipfile.ZipInfo (arcname, time.localtime (st.st_mtime)[:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+        zinfo.compress_type = self.compression
+
+        with open (filename, 'rb') as fp:
+            self.writestr (zinfo, fp.read (), compress_type)
+
+
+    def write_compressed (self, zinfo, file_size, result):
+        """ Write an already compressed member. """
+
+        crc, data = result
+
+        if self.date_time is not None:
+            zinfo.date_time = self.date_time
+        zinfo.file_size = file_size
+        zinfo.CRC = crc
+        zinfo.compress_size = len (data)
+        zinfo.header_offset = self.fp.tell ()
+
+        self._writecheck (zinfo)
+        self._didModify = True
+
+        self.fp.write (zinfo.FileHeader ())
+        self.fp.write (data)
+
+        self.filelist.append (zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+
+    def drain (self, max_pending):
+        """ Write compressed members in order.
+
+        Write all members that are ready, then wait until no more
+        than max_pending are left.
+
+        """
+
+        while self.pending and (len (self.pending) > max_pending or
+                                self.pending[0][2].ready ()):
+            zinfo, file_size, result = self.pending.popleft ()
+            self.write_compressed (zinfo, file_size, result.get ())
+
+
+    def flush (self):
+        """ Write all pending members. """
+        self.drain (0)
+
+
+    def stop_pool (self):
+        """ Stop the compressor threads. """
+
+        if self.pool is not None:
+            self.pool.terminate ()
+            self.pool.join ()
+            self.pool = None
+
+
+    def close (self):
+        """ Write pending members and close the zip file. """
+
+        if self.fp is not None:
+            self.flush ()
+        self.stop_pool ()
+        zipfile.ZipFile.close (self)
+
+
+    def discard (self):
+        """ Drop all pending members without writing them. """
+
+        self.pending.clear ()
+        self.stop_pool ()
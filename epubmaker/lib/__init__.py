@@ -1,5 +1,6 @@
 """ This is a package. """
 
-__all__ = ['DublinCore', 'DummyConnectionPool',
+__all__ = ['ArchiveURL', 'Cache', 'DublinCore', 'DummyConnectionPool', 'ExternalTools',
            'GutenbergDatabaseDublinCore', 'GutenbergDatabase',
-           'GutenbergGlobals', 'Logger', 'MediaTypes']
+           'GutenbergGlobals', 'HTTPPool', 'Logger', 'MediaTypes',
+           'ParallelZip']
@@ -20,6 +20,7 @@ import re
 
 from epubmaker.lib.Logger import info, warn, error
 import epubmaker.lib.GutenbergGlobals as gg
+from epubmaker.lib import ParallelZip
 
 from epubmaker.packagers import BasePackager
 
@@ -68,7 +69,10 @@ class Packager (BasePackager):
 
         info ('Creating Zip file: %s' % zipfilename)
 
-        zip_ = zipfile.ZipFile (zipfilename, 'w', zipfile.ZIP_DEFLATED)
+        zip_ = ParallelZip.ParallelZipFile (
+            zipfilename, zipfile.ZIP_DEFLATED,
+            getattr (self.options, 'zip_threads', 0),
+            ParallelZip.zip_date_time (getattr (self.options, 'build_time', None)))
 
         for suffix in '.txt -8.txt -0.txt .zip -8.zip -0.zip -rst.zip -h.zip'.split ():
             filename = '%s%s' % (ebook_no, suffix)
@@ -23,6 +23,7 @@ from pkg_resources import resource_listdir  # pylint: disable=E0611
 
 from epubmaker.lib.Logger import debug, info, warn, error
 import epubmaker.lib.GutenbergGlobals as gg
+from epubmaker.lib import ParallelZip
 
 GZIP_EXTENSION = '.gzip'
 
@@ -108,7 +109,10 @@ class HTMLishPackager (BasePackager):
 
         info ('Creating Zip file: %s' % zipfilename)
 
-        zip_ = zipfile.ZipFile (zipfilename, 'w', zipfile.ZIP_DEFLATED)
+        zip_ = ParallelZip.ParallelZipFile (
+            zipfilename, zipfile.ZIP_DEFLATED,
+            getattr (self.options, 'zip_threads', 0),
+            ParallelZip.zip_date_time (getattr (self.options, 'build_time', None)))
         info ('  Adding file: %s as %s' % (filename, memberfilename))
         zip_.write (filename, memberfilename)
 
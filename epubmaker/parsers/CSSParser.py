@@ -47,7 +47,7 @@ class Parser (ParserBase):
         
         parser = cssutils.CSSParser ()
         if self.fp:
-            self.sheet = parser.parseString (self.bytes_content (), encoding = self.encoding)
+            self.sheet = parser.parseString (self.bytes_content ()[:], encoding = self.encoding)
         else:
             self.sheet = parser.parseUrl (self.url)
 
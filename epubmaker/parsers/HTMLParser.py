@@ -23,12 +23,35 @@ from lxml import etree
 from epubmaker.lib.GutenbergGlobals import NS, xpath
 from epubmaker.lib.Logger import info, debug, warn, error
 from epubmaker.lib.MediaTypes import mediatypes as mt
+from epubmaker.lib import ExternalTools, Cache
+from epubmaker.CommonOptions import Options
 
 from epubmaker import parsers
 from epubmaker.parsers import HTMLParserBase
+from epubmaker.Version import VERSION
+
+options = Options()
 
 mediatypes = ('text/html', mt.xhtml)
 
+TIDY_ARGS = [
+    "-utf8",
+    "-clean",
+    "--wrap",             "0",
+    # "--drop-font-tags",   "y",
+    # "--drop-proprietary-attributes", "y",
+    # "--add-xml-space",    "y",
+    "--output-xhtml",     "y",
+    "--numeric-entities", "y",
+    "--merge-divs",       "n", # keep poetry indentation
+    "--merge-spans",      "n",
+    "--add-xml-decl",     "n",
+    "--doctype",          "strict",
+    "--anchor-as-name",   "n",
+    "--enclose-text",     "y" ]
+
+tidy_version = None # output of tidy -v
+
 RE_XMLDECL = re.compile ('<\?xml[^?]+\?>\s*')
 
 DEPRECATED = { 'align':      """caption applet iframe img input object legend
@@ -153,39 +176,23 @@ class Parser (HTMLParserBase):
 
 
     @staticmethod
-    def tidy (html):
-        """ Pipe html thru w3c tidy. """
+    def get_tidy_version ():
+        """ Return the version of tidy. Ask tidy only once. """
 
-        html = parsers.RE_RESTRICTED.sub ('', html)
-        html = RE_XMLDECL.sub ('', html)
-        html = parsers.RE_HTML_CHARSET.sub ('; charset=utf-8', html)
+        global tidy_version
 
-        # convert to xhtml
-        tidy = subprocess.Popen (
-            ["tidy",
-             "-utf8",
-             "-clean",
-             "--wrap",             "0",
-             # "--drop-font-tags",   "y",
-             # "--drop-proprietary-attributes", "y",
-             # "--add-xml-space",    "y",
-             "--output-xhtml",     "y",
-             "--numeric-entities", "y",
-             "--merge-divs",       "n", # keep poetry indentation
-             "--merge-spans",      "n",
-             "--add-xml-decl",     "n",
-             "--doctype",          "strict",
-             "--anchor-as-name",   "n",
-             "--enclose-text",     "y" ],
-
-            stdin = subprocess.PIPE,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE)
-
-        # print (html.encode ('utf-8'))
-        # sys.exit ()
-
-        (html, stderr) = tidy.communicate (html.encode ('utf-8'))
+        if tidy_version is None:
+            try:
+                tidy_version = subprocess.Popen (
+                    ["tidy", "-v"], stdout = subprocess.PIPE).communicate ()[0].strip ()
+            except OSError:
+                tidy_version = ''
+        return tidy_version
+
+
+    @staticmethod
+    def log_tidy_messages (stderr):
+        """ Log the messages tidy wrote to stderr. """
 
         regex = re.compile ('(Info:|Warning:|Error:)\s*', re.I)
 
@@ -205,9 +212,49 @@ class Parser (HTMLParserBase):
                 else:
                     error (line)
 
+
+    @staticmethod
+    def tidy (html):
+        """ Pipe html thru w3c tidy.
+
+        With --cache-tidy the output and the messages of tidy are
+        cached.  The key includes the version and the arguments of
+        tidy.  On a cache hit the messages are logged again.
+
+        """
+
+        html = parsers.RE_RESTRICTED.sub ('', html)
+        html = RE_XMLDECL.sub ('', html)
+        html = parsers.RE_HTML_CHARSET.sub ('; charset=utf-8', html)
+
+        key = None
+        if getattr (options, 'cache_tidy', False):
+            key = Cache.make_key (html, VERSION, Parser.get_tidy_version (), TIDY_ARGS)
+            cached = Cache.get_pickle ('tidy', key)
+            if cached is not None:
+                Parser.log_tidy_messages (cached['stderr'])
+                return cached['html'].decode ('utf-8')
+
+        # convert to xhtml
+        with ExternalTools.slot ():
+            tidy = subprocess.Popen (
+                ["tidy"] + TIDY_ARGS,
+                stdin = subprocess.PIPE,
+                stdout = subprocess.PIPE,
+                stderr = subprocess.PIPE)
+
+            # print (html.encode ('utf-8'))
+            # sys.exit ()
+
+            (html, stderr) = tidy.communicate (html.encode ('utf-8'))
+
+        Parser.log_tidy_messages (stderr)
+
         if tidy.returncode == 2:
             raise ValueError, stderr
 
+        if key is not None:
+            Cache.put_pickle ('tidy', key, { 'html': html, 'stderr': stderr })
         return html.decode ('utf-8')
 
 
@@ -15,18 +15,341 @@ Parse an url of type image/*.
 
 from __future__ import with_statement
 
+import os
+import struct
+import hashlib
+import collections
+import tempfile
 import StringIO
+import multiprocessing
 
 from PIL import Image
 
 from pkg_resources import resource_string # pylint: disable=E0611
 
-from epubmaker.lib.Logger import debug, error
+from epubmaker.lib.Logger import debug, info, error
 from epubmaker.lib.MediaTypes import mediatypes as mt
-from epubmaker.parsers import ParserBase
+from epubmaker.lib import Cache
+from epubmaker.parsers import ParserBase, is_mapped
+from epubmaker.Version import VERSION
 
 mediatypes = (mt.jpeg, mt.png, mt.gif)
 
+
+# read this many bytes to find the image dimensions
+PROBE_SIZE = 64 * 1024
+
+# JPEG start-of-frame markers: c0-cf minus DHT, JPG and DAC
+JPEG_SOF_MARKERS = set (range (0xc0, 0xd0)) - set ((0xc4, 0xc8, 0xcc))
+
+
+def probe_dimen (data):
+    """ Get (width, height) from the header of a PNG, GIF or JPEG image.
+
+    data needs to contain only the first few bytes of the image.
+    Returns None if the format is unknown or data is too short.
+
+    """
+
+    if data[:8] == '\x89PNG\r\n\x1a\n' and data[12:16] == 'IHDR' and len (data) >= 24:
+        return struct.unpack ('>II', data[16:24])
+
+    if data[:6] in ('GIF87a', 'GIF89a') and len (data) >= 10:
+        return struct.unpack ('<HH', data[6:10])
+
+    if data[:2] == '\xff\xd8':
+        i = 2
+        while i + 4 <= len (data):
+            if data[i] != '\xff':
+                return None # lost sync
+            marker = ord (data[i + 1])
+            if marker == 0xff:
+                # fill byte
+                i += 1
+                continue
+            if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+                # markers without length
+                i += 2
+                continue
+            if marker in JPEG_SOF_MARKERS:
+                if i + 9 > len (data):
+                    return None
+                height, width = struct.unpack ('>HH', data[i + 5:i + 9])
+                return width, height
+            i += 2 + struct.unpack ('>H', data[i + 2:i + 4])[0]
+
+    return None
+
+
+# JPEG qualities we try, ascending
+QUALITIES = range (10, 95, 5)
+
+# if an image doesn't fit even at the lowest quality, shrink it by this
+# much more than the size ratio suggests, at most this many times
+DOWNSCALE_MARGIN = 0.9
+MAX_DOWNSCALES = 3
+
+# how many images per process may be in the works at once
+PENDING_PER_PROCESS = 2
+
+# (sha1 of source, max_size, max_dimen, output_format) -> (quality, dimen)
+chosen_qualities = {}
+
+
+def open_image (data):
+    """ Open an image from bytes or from a mapped file.
+
+    PIL reads a mapped file like any other file, so it is not copied.
+
+    """
+
+    if is_mapped (data):
+        data.seek (0)
+        return Image.open (data)
+    return Image.open (StringIO.StringIO (data))
+
+
+def encode (image, format_, quality):
+    """ Encode image. Return bytes. """
+
+    buf = StringIO.StringIO ()
+    image.save (buf, format_, quality = quality)
+    return buf.getvalue ()
+
+
+def find_quality (image, format_, max_size):
+    """ Find the best quality at which image fits into max_size.
+
+    Returns (quality, data).  quality is None if the image doesn't fit
+    even at the lowest quality.
+
+    """
+
+    if format_.lower () not in ('jpeg', 'jpg'):
+        # quality means nothing to png and gif
+        data = encode (image, format_, QUALITIES[-1])
+        return (QUALITIES[-1] if len (data) <= max_size else None), data
+
+    # encode at highest quality
+    hi = len (QUALITIES) - 1
+    data = encode (image, format_, QUALITIES[hi])
+    if len (data) <= max_size:
+        return QUALITIES[hi], data
+
+    # JPEG size falls roughly linearly with quality: use the first
+    # encode to guess where to start the bisection
+    best = None
+    smallest = data
+    lo = 0
+    guess = int (QUALITIES[hi] * float (max_size) / len (data))
+    i = max (lo, min (hi - 1, (guess - QUALITIES[0]) // 5))
+
+    while lo < hi:
+        data = encode (image, format_, QUALITIES[i])
+        if len (data) <= max_size:
+            best = QUALITIES[i], data
+            lo = i + 1
+        else:
+            smallest = data
+            hi = i
+        i = (lo + hi) // 2
+
+    return best or (None, smallest)
+
+
+def resize_image_data (image_data, max_size, max_dimen, output_format = None,
+                       hint = None, downscale = False):
+    """ Resize an image to fit into max_dimen and max_size.
+
+    hint is the (quality, dimen) chosen the last time for this image
+    and these parameters.  If downscale is set, images that don't fit
+    into max_size even at the lowest quality get scaled down further.
+
+    Returns (data, dimen, comment, (quality, dimen)).
+
+    """
+
+    image = open_image (image_data)
+
+    format_ = image.format
+    if output_format:
+        format_ = output_format
+    if format_ == 'gif':
+        format_ = 'png'
+    if format_ == 'jpeg' and image.mode.lower () != 'rgb':
+        image = image.convert ('RGB')
+
+    if 'dpi' in image.info:
+        del image.info['dpi']
+
+    # maybe resize image
+
+    # find scaling factor
+    scale = 1.0
+    scale = min (scale, max_dimen[0] / float (image.size[0]))
+    scale = min (scale, max_dimen[1] / float (image.size[1]))
+
+    was = ''
+    orig_size = image.size
+    dimen = None
+    if scale < 1.0:
+        dimen = (int (image.size[0] * scale), int (image.size[1] * scale))
+    if hint and tuple (hint[1]) != image.size:
+        # last time we had to downscale further
+        dimen = tuple (hint[1])
+    if dimen:
+        was = "(was %d x %d scale=%.2f) " % (
+            orig_size[0], orig_size[1], dimen[0] / float (orig_size[0]))
+        image = image.resize (dimen, Image.ANTIALIAS)
+
+    quality = None
+    data = image_data
+    if dimen or (len (image_data) > max_size):
+        if hint:
+            # try last time's choice first
+            data = encode (image, format_, hint[0])
+            if len (data) <= max_size:
+                quality = hint[0]
+
+        if quality is None:
+            # find best quality that fits into max_size
+            quality, data = find_quality (image, format_, max_size)
+
+        for dummy_i in range (MAX_DOWNSCALES):
+            if quality is not None or not downscale:
+                break
+            factor = (float (max_size) / len (data)) ** 0.5 * DOWNSCALE_MARGIN
+            dimen = (max (1, int (image.size[0] * factor)),
+                     max (1, int (image.size[1] * factor)))
+            was = "(was %d x %d scale=%.2f) " % (
+                orig_size[0], orig_size[1], dimen[0] / float (orig_size[0]))
+            image = image.resize (dimen, Image.ANTIALIAS)
+            quality, data = find_quality (image, format_, max_size)
+
+        if quality is not None:
+            was += 'q=%d' % quality
+
+    comment = "Image: %d x %d size=%d %s" % (
+                image.size[0], image.size[1], len (data), was)
+    debug (comment)
+
+    return data, tuple (image.size), comment, (quality, tuple (image.size))
+
+
+class SyncResult (object):
+    """ Looks like the AsyncResult of a job that ran in this process. """
+
+    def __init__ (self, result):
+        self.result = result
+
+    def ready (self):
+        """ Always ready. """
+        return True
+
+    def get (self):
+        """ Return the result. """
+        return self.result
+
+
+def resize_image_job (args):
+    """ Resize one image. Runs in a pool worker.
+
+    Returns (data, dimen, comment, choice) or (None, None, error
+    message, None).
+
+    """
+
+    try:
+        return resize_image_data (*args)
+    except IOError, what:
+        return None, None, str (what), None
+
+
+def finish_resize (job, key, downscale, result, async_result):
+    """ Make the new parser for one job of resize_images (). """
+
+    if async_result is not None:
+        result = async_result.get ()
+        # a mapped file comes back if the image needed no
+        # resizing, don't copy it into the cache
+        if result[0] is not None and not is_mapped (result[0]):
+            Cache.put_pickle ('images', Cache.make_key (key, downscale, VERSION), result)
+
+    data, dimen, comment, choice = result
+    if choice is not None and choice[0] is not None:
+        chosen_qualities[key] = choice
+    return job[0].resized_parser ((data, dimen, comment))
+
+
+def resize_images (jobs, processes = 1, downscale = False):
+    """ Resize many images, maybe in parallel.
+
+    jobs is a list of (parser, max_size, max_dimen, output_format).
+    Yields new parsers in the same order, each one as soon as it is
+    ready, so the caller need not hold all of them at once.
+
+    The images are read and looked up in the cache one at a time, and
+    only a few per process are in the works at once, so the images
+    of the book need not all be in memory.
+
+    Results are kept in the 'images' namespace of the disk cache, so
+    the same image with the same parameters is resized only once.
+
+    """
+
+    pool = None
+    window = 0
+    if processes > 1 and len (jobs) > 1:
+        pool = multiprocessing.Pool (min (processes, len (jobs)))
+        window = processes * PENDING_PER_PROCESS
+
+    # (job, key, result, async result)
+    pending = collections.deque ()
+    hits = 0
+
+    def ready ():
+        """ Is the first pending job done? """
+        return pending[0][3] is None or pending[0][3].ready ()
+
+    try:
+        for job in jobs:
+            p, max_size, max_dimen, output_format = job
+            image_data = p.image_data
+            key = (hashlib.sha1 (image_data).hexdigest (), max_size, max_dimen, output_format)
+
+            result = Cache.get_pickle ('images', Cache.make_key (key, downscale, VERSION))
+            async_result = None
+            if result is not None:
+                hits += 1
+            else:
+                args = (image_data, max_size, max_dimen, output_format,
+                        chosen_qualities.get (key), downscale)
+                if pool is None:
+                    async_result = SyncResult (resize_image_job (args))
+                else:
+                    # pool workers need a copy of mapped files anyway
+                    async_result = pool.apply_async (
+                        resize_image_job, ((image_data[:], ) + args[1:], ))
+            image_data = None
+
+            pending.append ((job, key, result, async_result))
+            while pending and (len (pending) > window or ready ()):
+                job, key, result, async_result = pending.popleft ()
+                yield finish_resize (job, key, downscale, result, async_result)
+
+        while pending:
+            job, key, result, async_result = pending.popleft ()
+            yield finish_resize (job, key, downscale, result, async_result)
+
+        if jobs:
+            info ("Resized images: %d cache hits, %d misses" % (hits, len (jobs) - hits))
+
+    finally:
+        if pool is not None:
+            pool.terminate ()
+            pool.join ()
+
+
 class Parser (ParserBase):
     """Parse an image.
 
@@ -36,77 +359,168 @@ class Parser (ParserBase):
 
     def __init__ (self):
         ParserBase.__init__ (self)
-        self.image_data = None
+        self._image_data = None
+        self.spill_filename = None
+        self.prefix = None # first bytes, if read before the rest
+        self.unmapped = False # True if the mapped image data was closed
         self.dimen = None
         self.comment = None
 
 
-    def resize_image (self, max_size, max_dimen, output_format = None):
-        """ Create a new parser with a resized image. """
+    def _get_image_data (self):
+        if self.spill_filename is not None:
+            with open (self.spill_filename, 'rb') as fp:
+                return fp.read ()
+        if self._image_data is None and self.unmapped:
+            # map it again
+            self.unmapped = False
+            self._image_data = self.bytes_content ()
+        return self._image_data
 
-        new_parser = Parser ()
 
-        try:
-            image = Image.open (StringIO.StringIO (self.image_data))
+    def _set_image_data (self, data):
+        self.unspill ()
+        self._image_data = data
 
-            format_ = image.format
-            if output_format:
-                format_ = output_format
-            if format_ == 'gif':
-                format_ = 'png'
-            if format_ == 'jpeg' and image.mode.lower () != 'rgb':
-                image = image.convert ('RGB')
+    image_data = property (_get_image_data, _set_image_data)
 
-            if 'dpi' in image.info:
-                del image.info['dpi']
 
-            # maybe resize image
+    def spill (self):
+        """ Move the image data out of memory into a temp file.
 
-            # find scaling factor
-            scale = 1.0
-            scale = min (scale, max_dimen[0] / float (image.size[0]))
-            scale = min (scale, max_dimen[1] / float (image.size[1]))
+        Return the no. of bytes freed.
 
-            was = ''
-            if scale < 1.0:
-                dimen = (int (image.size[0] * scale), int (image.size[1] * scale))
-                was = "(was %d x %d scale=%.2f) " % (image.size[0], image.size[1], scale)
-                image = image.resize (dimen, Image.ANTIALIAS)
+        """
 
-            # find best quality that fits into max_size
-            data = self.image_data
-            if (scale < 1.0) or (len (self.image_data) > max_size):
-                for quality in (90, 85, 80, 70, 60, 50, 40, 30, 20, 10):
-                    buf = StringIO.StringIO ()
-                    image.save (buf, format_, quality = quality)
-                    data = buf.getvalue ()
-                    if (len (data) <= max_size):
-                        was += 'q=%d' % quality
-                        break
-
-            comment = "Image: %d x %d size=%d %s" % (
-                        image.size[0], image.size[1], len (data), was)
-            debug (comment)
-
-            new_parser.mediatype = self.mediatype
-            new_parser.image_data = data
-            new_parser.dimen = tuple (image.size)
-            new_parser.comment = comment
-            new_parser.url = self.url
-            new_parser.orig_url = self.orig_url
-            new_parser.attribs = self.attribs
-            new_parser.fp = self.fp
-
-        except IOError, what:
-            error ("Could not resize image: %s" % what)
+        if self._image_data is None:
+            return 0
+
+        if is_mapped (self._image_data):
+            # the file is still there, just unmap it
+            return self.unmap ()
+
+        size = self.footprint ()
+        fd, self.spill_filename = tempfile.mkstemp (prefix = 'epubmaker-', suffix = '.img')
+        with os.fdopen (fd, 'wb') as fp:
+            fp.write (self._image_data)
+        self._image_data = None
+        self.buffer = None
+        debug ("Spilled %s to %s" % (self.url, self.spill_filename))
+        return size
+
+
+    def unspill (self):
+        """ Remove the temp file. """
+
+        if self.spill_filename is not None:
+            try:
+                os.remove (self.spill_filename)
+            except OSError:
+                pass
+            self.spill_filename = None
+
+
+    def unmap (self):
+        """ Close the mapped file. It gets mapped again when needed. """
+
+        if not is_mapped (self.buffer):
+            return 0
+        if self._image_data is self.buffer:
+            self._image_data = None
+            self.unmapped = True
+        return ParserBase.unmap (self)
+
+
+    def footprint (self):
+        """ Estimate the memory used by this parser in bytes. """
+
+        size = len (self._image_data or '')
+        if self.buffer is not self._image_data:
+            size += ParserBase.footprint (self)
+        return size
+
+
+    def bytes_content (self):
+        """ Get document content as raw bytes. """
+
+        if self.spill_filename is not None:
+            return self.image_data
+
+        if self.buffer is None:
+            self.buffer = self.map_content ()
+
+        if self.prefix is not None and self.buffer is None:
+            # get_image_dimen () already read the first bytes
+            try:
+                self.buffer = self.prefix + self.fp.read ()
+                self.fp.close ()
+                self.prefix = None
+            except IOError, what:
+                error (what)
+
+        return ParserBase.bytes_content (self)
+
+
+    def header_bytes (self):
+        """ Get the first bytes of the image without loading all of it. """
+
+        if self._image_data is not None:
+            return self._image_data
+        if self.buffer is not None:
+            return self.buffer
+        if self.spill_filename is not None:
+            with open (self.spill_filename, 'rb') as fp:
+                return fp.read (PROBE_SIZE)
+        if self.prefix is None and self.fp is not None:
+            self.buffer = self.map_content ()
+            if self.buffer is not None:
+                return self.buffer
+            try:
+                self.prefix = self.fp.read (PROBE_SIZE)
+            except IOError, what:
+                error (what)
+                return ''
+        return self.prefix or ''
+
+
+    def resize_image (self, max_size, max_dimen, output_format = None):
+        """ Create a new parser with a resized image. """
+
+        return resize_images ([(self, max_size, max_dimen, output_format)]).next ()
+
+
+    def resized_parser (self, result):
+        """ Make a new parser from the result of resize_image_job (). """
+
+        new_parser = Parser ()
+
+        data, dimen, comment = result
+        if data is None:
+            error ("Could not resize image: %s" % comment)
             new_parser.broken_image ()
+            return new_parser
+
+        new_parser.mediatype = self.mediatype
+        new_parser.image_data = data
+        new_parser.dimen = dimen
+        new_parser.comment = comment
+        new_parser.url = self.url
+        new_parser.orig_url = self.orig_url
+        new_parser.attribs = self.attribs
+        new_parser.fp = self.fp
 
         return new_parser
 
 
     def get_image_dimen (self):
+        """ Get the image dimensions. Decode the image only if we must. """
+
+        if self.dimen is None:
+            self.dimen = probe_dimen (self.header_bytes ())
         if self.dimen is None:
-            image = Image.open (StringIO.StringIO (self.image_data))
+            # exotic format or huge header
+            self.pre_parse ()
+            image = open_image (self.image_data)
             self.dimen = image.size
         return self.dimen
 
@@ -121,10 +535,10 @@ class Parser (ParserBase):
 
 
     def pre_parse (self):
-        if self.image_data is None:
+        if self._image_data is None and self.spill_filename is None:
             self.image_data = self.bytes_content ()
-        if self.image_data is None:
-            self.broken_image ()
+            if self._image_data is None:
+                self.broken_image ()
 
 
     def parse (self):
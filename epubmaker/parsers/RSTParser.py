@@ -25,24 +25,26 @@ from lxml import etree
 import lxml.html
 
 import docutils.readers.standalone
-from docutils import nodes, frontend, io
+from docutils import nodes, frontend, io, utils
 
 from pkg_resources import resource_string # pylint: disable=E0611
 
 from epubmaker.lib.GutenbergGlobals import NS, xpath
 from epubmaker.lib.Logger import info, debug, warn, error
 from epubmaker.lib.MediaTypes import mediatypes as mt
+from epubmaker.lib import Cache
 
 from epubmaker import ParserFactory
+from epubmaker import parsers
 from epubmaker.parsers import HTMLParser
 
 from epubmaker.mydocutils import broken
-from epubmaker.mydocutils import nodes as mynodes
 from epubmaker.mydocutils.writers import xhtml1, epub2, xetex
 
 from epubmaker.mydocutils.gutenberg import parsers as gutenberg_parsers
 from epubmaker.mydocutils.gutenberg.writers import nroff as gutenberg_nroff
 from epubmaker.CommonOptions import Options
+from epubmaker.Version import VERSION
 
 options = Options()
 
@@ -50,6 +52,10 @@ mediatypes = (mt.rst, )
 
 RE_EMACS_CHARSET = re.compile (r'-\*-.*coding:\s*(\S+)',  re.I)
 
+# settings that change the doctree the parser builds.  All other
+# settings are only used by transforms and writers.
+PARSE_SETTINGS = ('page_numbers', 'tab_width')
+
 class Parser (HTMLParser.Parser):
     """ Parse a ReStructured Text 
 
@@ -57,9 +63,12 @@ class Parser (HTMLParser.Parser):
 
     """
 
+    links_depend_on_want_images = True
+
     def __init__ (self):
         HTMLParser.Parser.__init__ (self)
         self.document1 = None
+        self.doctrees = {} # parse settings -> untransformed doctree
 
 
     def preprocess (self, charset):
@@ -98,10 +107,24 @@ class Parser (HTMLParser.Parser):
         return xhtml
 
 
+    def footprint (self):
+        """ Estimate the memory used by this parser in bytes. """
+
+        size = len (self.buffer or '')
+        return (parsers.ParserBase.footprint (self) +
+                len (self.doctrees) * parsers.TREE_OVERHEAD * size)
+
+
     def rewrite_links (self, f):
         """ Rewrite all links using the function f. """
 
-        doc = self.document1
+        for doc in self.doctrees.values ():
+            self._rewrite_links (doc, f)
+
+
+    @staticmethod
+    def _rewrite_links (doc, f):
+        """ Rewrite all links in doc using the function f. """
 
         if 'coverpage' in doc.meta_block:
             coverpage = doc.meta_block['coverpage']
@@ -178,110 +201,124 @@ class Parser (HTMLParser.Parser):
         return option_parser.get_default_values ()
 
 
-    def pre_parse (self):
-        """ Parse a RST file as link list. """
+    def _read (self, overrides):
+        """ Parse the source into a doctree without applying transforms.
 
-        debug ("RSTParser: Pre-parsing %s" % self.url)
+        The doctree is cached. One doctree serves all writers
+        that agree on the settings in PARSE_SETTINGS.
 
-        default_style = self.get_resource (
-            'mydocutils.parsers', 'default_style.rst').decode ('utf-8')
+        """
 
-        source = io.StringInput (default_style + self.unicode_content ())
         reader = docutils.readers.standalone.Reader ()
         parser = gutenberg_parsers.Parser ()
+        settings = self.get_settings ((reader, parser), overrides)
 
-        overrides = {
-            'get_resource': self.get_resource,
-            'get_image_size': self.get_image_size_from_parser,
-            'no_images': not self.options.want_images,
-            'base_url': self.url,
-            }
+        key = tuple ([getattr (settings, name, None) for name in PARSE_SETTINGS])
+        if key not in self.doctrees:
+            default_style = self.get_resource (
+                'mydocutils.parsers', 'default_style.rst').decode ('utf-8')
 
-        doc = reader.read (
-            source, parser, self.get_settings ((reader, parser), overrides))
-        self.document1 = doc
+            cache_key = Cache.make_key (self.bytes_content (), default_style,
+                                        VERSION, key, self.url)
+            doc = self._load_doctree (cache_key, settings)
 
-        self.rewrite_links (partial (urlparse.urljoin, self.url))
+            if doc is None:
+                debug ("RSTParser: Parsing %s" % self.url)
 
-        debug ("RSTParser: Done pre-parsing %s" % self.url)
+                source = io.StringInput (default_style + self.unicode_content (), 
+                                         self.url, 'unicode')
 
+                doc = reader.read (source, parser, settings)
+                self._rewrite_links (doc, partial (urlparse.urljoin, self.url))
+                self._store_doctree (cache_key, doc)
 
-    def _full_parse (self, writer, overrides):
-        """ Full parse from scratch. """
+                debug ("RSTParser: Done parsing %s" % self.url)
 
-        debug ("RSTParser: Full-parsing %s" % self.url)
+            self.doctrees[key] = doc
 
-        default_style = self.get_resource (
-            'mydocutils.parsers', 'default_style.rst').decode ('utf-8')
+        return self.doctrees[key]
 
-        source = io.StringInput (default_style + self.unicode_content (), 
-                                 self.url, 'unicode')
-        reader = docutils.readers.standalone.Reader ()
-        parser = gutenberg_parsers.Parser ()
 
-        doc = reader.read (
-            source, parser, 
-            self.get_settings ((reader, parser, writer), overrides))
-        self.document1 = doc
+    def _load_doctree (self, cache_key, settings):
+        """ Get a doctree from the disk cache. """
 
-        self.rewrite_links (partial (urlparse.urljoin, self.url))
+        doc = Cache.get_pickle ('doctree', cache_key)
+        if doc is not None:
+            debug ("RSTParser: Got doctree for %s from cache" % self.url)
+            doc.settings = settings
+            doc.reporter = utils.new_reporter (doc.get ('source', self.url), settings)
+        return doc
 
-        doc.transformer.populate_from_components ((source, reader, parser, writer))
-        doc.transformer.apply_transforms ()
-        debug ("RSTParser: Done full-parsing %s" % self.url)
 
-        return doc
+    @staticmethod
+    def _store_doctree (cache_key, doc):
+        """ Put a doctree into the disk cache.
 
+        Settings and reporter are not picklable (they hold references
+        to this parser and to output streams) so we detach them while
+        pickling.  If the doctree still contains something that cannot
+        be pickled, it just doesn't get cached.
 
-    def _full_parse_2 (self, writer, destination, overrides):
-        """ Full parser from pickled doctree. 
+        """
 
-        Doesn't work yet. It turned out pickling a doctree is much
-        harder than I thought. """
+        settings, reporter = doc.settings, doc.reporter
+        doc.settings = doc.reporter = None
+        try:
+            Cache.put_pickle ('doctree', cache_key, doc)
+        finally:
+            doc.settings, doc.reporter = settings, reporter
 
-        debug ("Full-parsing %s" % self.url)
 
-        source = io.StringInput (self.unicode_content ())
-        reader = docutils.readers.standalone.Reader ()
-        parser = gutenberg_parsers.Parser ()
+    def pre_parse (self):
+        """ Parse a RST file as link list. """
+
+        # cache
+        if self.document1 is not None:
+            return
+
+        debug ("RSTParser: Pre-parsing %s" % self.url)
+
+        overrides = {
+            'get_resource': self.get_resource,
+            'get_image_size': self.get_image_size_from_parser,
+            'no_images': not self.options.want_images,
+            'page_numbers': 1, # same as all writers, so we can share the doctree
+            'base_url': self.url,
+            }
 
-        doc = reader.read (
-            source, parser, 
-            self.get_settings ((reader, parser, writer), overrides))
-        self.document1 = doc
+        self.document1 = self._read (overrides)
 
-        self.rewrite_links (partial (urlparse.urljoin, self.url))
+        debug ("RSTParser: Done pre-parsing %s" % self.url)
 
-        # make it picklable
-        reporter = doc.reporter #  = None
-        # doc.reporter = None
-        transformer = doc.transformer
-        doc.settings = None
-        from docutils.parsers.rst.directives.html import MetaBody
 
-        #for metanode in doc.traverse (MetaBody.meta):
-        for pending in doc.traverse (nodes.pending):
-            # pending.transform = None
-            # docutils' meta nodes aren't picklable because the class is nested
-            # in pending['nodes']
-            if 'nodes' in pending.details: 
-                if isinstance (pending.details['nodes'][0], MetaBody.meta):
-                    pending.details['nodes'][0].__class__ = mynodes.meta
-        import cPickle as pickle
-        pickled = pickle.dumps (doc)
+    def _full_parse (self, writer, overrides):
+        """ Get a private copy of the cached doctree and transform it. """
 
-        doc = pickle.loads (pickled)
+        debug ("RSTParser: Full-parsing %s" % self.url)
 
-        #doc.transformer.populate_from_components (
-        #    (source, reader, parser, writer))
+        cached = self._read (overrides)
 
-        doc.transformer = transformer
-        doc.reporter = reporter
-        doc.settings = self.get_settings ((reader, parser, writer), overrides)
+        source = io.StringInput (u'', self.url, 'unicode')
+        reader = docutils.readers.standalone.Reader ()
+        parser = gutenberg_parsers.Parser ()
+        settings = self.get_settings ((reader, parser, writer), overrides)
+
+        # Don't copy settings and reporter. They hold references to
+        # this parser and to output streams.  The transformer gets
+        # copied along with the document so the pending transforms
+        # point to the pending nodes in the copy.
+        memo = {
+            id (cached.settings): settings,
+            id (cached.reporter): utils.new_reporter (
+                cached.get ('source', self.url), settings),
+            }
+        doc = copy.deepcopy (cached, memo)
 
+        doc.transformer.populate_from_components ((source, reader, parser, writer))
         doc.transformer.apply_transforms ()
+        debug ("RSTParser: Done full-parsing %s" % self.url)
 
-        return writer.write (doc, destination)
+        return doc
 
 
     def rst2nroff (self, charset = 'utf-8'):
@@ -377,7 +414,7 @@ class Parser (HTMLParser.Parser):
     def get_image_size_from_parser (self, uri):
         # debug ("Getting image dimen for %s" % uri)
         parser = ParserFactory.ParserFactory.create (uri, {})
-        parser.pre_parse ()
+        # get_image_dimen () needs only the image header
         if hasattr (parser, 'get_image_dimen'):
             return parser.get_image_dimen ()
         return None
@@ -11,7 +11,14 @@ Distributable under the GNU General Public License Version 3 or newer.
 
 """
 
+import os
 import re
+import sys
+import copy
+import mmap
+import codecs
+import weakref
+import urllib
 import urlparse
 
 import lxml.html
@@ -62,10 +69,56 @@ BOGUS_CHARSET_NAMES = { 'iso-latin-1': 'iso-8859-1',
                         'macintosh'  : 'mac_roman',
                         }
 
+# rough ratio of memory used by a parsed tree to the size of its source
+TREE_OVERHEAD = 10
+
+# map local files at least this big instead of reading them
+MMAP_MIN_SIZE = 256 * 1024
+
+# every map holds a file descriptor: read files instead of mapping
+# them if this many are mapped
+MAX_MAPPED_FILES = 128
+
+# try a charset on this many bytes before decoding the whole file
+SNIFF_SIZE = 64 * 1024
+
+# bytes per character of a unicode string
+UNICODE_CHAR_SIZE = 4 if sys.maxunicode > 0xffff else 2
+
+TOC_HEADER_TAGS = frozenset ((NS.xhtml.h1, NS.xhtml.h2, NS.xhtml.h3, NS.xhtml.h4))
+
+
+def map_file (filename):
+    """ Map a local file read-only into memory.
+
+    Returns None if the file is too small to bother or cannot be
+    mapped.
+
+    """
+
+    try:
+        with open (filename, 'rb') as fp:
+            if os.fstat (fp.fileno ()).st_size < MMAP_MIN_SIZE:
+                return None
+            return mmap.mmap (fp.fileno (), 0, access = mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def is_mapped (data):
+    """ Return True if data is a mapped file. """
+    return isinstance (data, mmap.mmap)
+
 
 class ParserBase (object):
     """ Base class for more specialized parsers. """
 
+    # True if iterlinks () returns other links in a noimages build
+    links_depend_on_want_images = False
+
+    # parsers that hold a mapped file
+    mapped_parsers = weakref.WeakSet ()
+
     def __init__ (self):
         self.orig_url       = None
         self.url            = None
@@ -76,7 +129,11 @@ class ParserBase (object):
         self.id             = None
 
         self.buffer         = None
+        self.unicode_buffer = None  # decoded buffer
         self.options        = None
+
+        self.last_used      = 0     # for the ParserFactory LRU
+        self.serialized     = False # True if already written to an output
         
 
     def setup (self, orig_url, mediatype, attribs, fp):
@@ -87,6 +144,7 @@ class ParserBase (object):
         self.fp             = fp
         self.url            = fp.geturl ()
         self.buffer         = None
+        self.unicode_buffer = None
 
 
     def pre_parse (self):
@@ -209,8 +267,60 @@ class ParserBase (object):
         return encoding or 'windows-1252'
 
 
+    def map_content (self):
+        """ Map the document into memory if it is a big local file.
+
+        Returns the mapped file or None.
+
+        """
+
+        if self.fp is None:
+            return None
+        url = self.fp.geturl ()
+        if not url.startswith ('file:'):
+            return None
+        if len (ParserBase.mapped_parsers) >= MAX_MAPPED_FILES:
+            return None
+
+        buffer_ = map_file (urllib.url2pathname (urlparse.urlparse (url).path))
+        if buffer_ is not None:
+            debug ("Mapped %s" % url)
+            self.fp.close ()
+            ParserBase.mapped_parsers.add (self)
+        return buffer_
+
+
+    def unmap (self):
+        """ Close the mapped file and its file descriptor.
+
+        The file gets mapped again if it is needed again.
+        Return the no. of bytes freed.
+
+        """
+
+        if not is_mapped (self.buffer):
+            return 0
+
+        size = len (self.buffer)
+        self.buffer.close ()
+        self.buffer = None
+        ParserBase.mapped_parsers.discard (self)
+        debug ("Unmapped %s" % self.url)
+        return size
+
+
     def bytes_content (self):
-        """ Get document content as raw bytes. """
+        """ Get document content as raw bytes.
+
+        Big local files are mapped instead of read.  The mapped file
+        is not a str but can be searched with regexes, sliced, hashed
+        and decoded with unicode ().  Take a slice [:] to get a str,
+        that costs nothing if it already is one.
+
+        """
+
+        if self.buffer is None:
+            self.buffer = self.map_content ()
 
         if self.buffer is None:
             try:
@@ -224,7 +334,20 @@ class ParserBase (object):
         
 
     def unicode_content (self):
-        """ Get document content as unicode string. """
+        """ Get document content as unicode string.
+
+        The document is decoded only once, the text and the encoding
+        are remembered.
+
+        """
+
+        if self.unicode_buffer is None:
+            self.unicode_buffer = self.decode_content ()
+        return self.unicode_buffer
+
+
+    def decode_content (self):
+        """ Find the charset and decode the document. """
 
         data = (self.decode (self.get_charset_from_content_type ()) or
                 self.decode (self.get_charset_from_meta ()) or
@@ -259,7 +382,12 @@ class ParserBase (object):
         try:
             debug ("Trying charset %s ..." % charset)
             self.encoding = charset
-            return self.bytes_content ().decode (charset)
+            data = self.bytes_content ()
+            if len (data) > SNIFF_SIZE:
+                # a wrong charset usually fails early,
+                # so try it on the start before decoding everything
+                codecs.getincrementaldecoder (charset) ().decode (data[:SNIFF_SIZE], False)
+            return unicode (data, charset)
         except LookupError, what:
             # unknown charset, 
             self.encoding = None
@@ -274,6 +402,18 @@ class ParserBase (object):
     # Links are found in HTMLParserBase and CSSParser. These methods
     # are overwritten there.
 
+    def footprint (self):
+        """ Estimate the memory used by this parser in bytes.
+
+        Mapped files count too, so the budget gets their file
+        descriptors back.
+
+        """
+
+        size = len (self.unicode_buffer or '') * UNICODE_CHAR_SIZE
+        return size + len (self.buffer or '')
+
+
     def iterlinks (self): # pylint: disable=R0201
         """ Return all links in document. 
 
@@ -310,6 +450,43 @@ class HTMLParserBase (ParserBase):
     def __init__ (self):
         ParserBase.__init__ (self)
         self.xhtml = None
+        self.cleaned = {} # key -> (cleaned xhtml, data)
+
+
+    def footprint (self):
+        """ Estimate the memory used by this parser in bytes. """
+
+        size = len (self.buffer or '')
+        trees = len (self.cleaned)
+        if self.xhtml is not None:
+            trees += 1
+        return ParserBase.footprint (self) + trees * TREE_OVERHEAD * size
+
+
+    def cleaned_xhtml (self, key, clean, keep):
+        """ Get a copy of the tree cleaned by clean ().
+
+        Writers that clean the tree the same way share one cleaned
+        tree under the same key, so the cleanup runs only once per
+        document.  clean (xhtml) cleans the tree in place and returns
+        whatever the writers need along with it, eg. the TOC.
+
+        Returns (xhtml, data).  The caller may change xhtml but not
+        data.  If keep is true the cleaned tree is kept for the next
+        writer and the caller gets a copy, else the caller gets the
+        cleaned tree itself and it is forgotten.
+
+        """
+
+        if key not in self.cleaned:
+            self.parse ()
+            xhtml = copy.deepcopy (self.xhtml)
+            self.cleaned[key] = (xhtml, clean (xhtml))
+
+        if keep:
+            xhtml, data = self.cleaned[key]
+            return copy.deepcopy (xhtml), data
+        return self.cleaned.pop (key)
 
 
     def setup (self, orig_url, mediatype, attribs, fp):
@@ -408,18 +585,26 @@ class HTMLParserBase (ParserBase):
 
         """
         
-        for link in xpath (xhtml, '//xhtml:link[@href]'):
-            href = link.get ('href')
-            if href not in manifest:
+        for elem in xpath (xhtml, '//xhtml:link[@href]|//xhtml:img[@src]'):
+            HTMLParserBase.strip_link (elem, manifest)
+
+
+    @staticmethod
+    def strip_link (elem, manifest):
+        """ Strip <link> or <img> if it links to an url not in manifest. """
+
+        if elem.tag == NS.xhtml.link:
+            href = elem.get ('href')
+            if href is not None and href not in manifest:
                 debug ("strip_links: Deleting <link> to %s not in manifest." % href)
-                link.drop_tree ()
-                
-        for image in xpath (xhtml, '//xhtml:img[@src]'):
-            src = image.get ('src')
-            if src not in manifest:
+                elem.drop_tree ()
+
+        elif elem.tag == NS.xhtml.img:
+            src = elem.get ('src')
+            if src is not None and src not in manifest:
                 debug ("strip_links: Deleting <img> with src %s not in manifest." % src)
-                image.tail = image.get ('alt', '') + (image.tail or '')
-                image.drop_tree ()
+                elem.tail = elem.get ('alt', '') + (elem.tail or '')
+                elem.drop_tree ()
 
                 
     def make_toc (self, xhtml):
@@ -432,22 +617,7 @@ class HTMLParserBase (ParserBase):
         
         """
 
-        def id_generator (i = 0):
-            """ Generate an id for the TOC to link to. """
-            while True:
-                yield 'pgepubid%05d' % i
-                i += 1
-
-        idg = id_generator ()
-        
-        def get_id (elem):
-            """ Get the id of the element or generate and set one. """
-            if not elem.get ('id'):
-                elem.set ('id', idg.next ()) # pylint: disable=E1101
-            return elem.get ('id')
-
-        toc = []
-        last_depth = 0
+        toc = TocBuilder (self.url)
 
         for header in xpath (xhtml, 
             '//xhtml:h1|//xhtml:h2|//xhtml:h3|//xhtml:h4|'
@@ -456,48 +626,9 @@ class HTMLParserBase (ParserBase):
             # DocUtils contents header
             '//xhtml:p[contains (@class, "topic-title")]'):
 
-            text = gg.normalize (etree.tostring (header,
-                                                 method = "text",
-                                                 encoding = unicode,
-                                                 with_tail = False))
-            
-            text = header.get ('title', text).strip ()
-
-            if not text:
-                # so <h2 title=""> may be used to suppress TOC entry
-                continue
-
-            if header.get ('class', '').find ('pageno') > -1:
-                toc.append ( ["%s#%s" % (self.url, get_id (header)), text, -1] )
-            else:
-                # header
-                if text.lower ().startswith ('by '):
-                    # common error in PG: <h2>by Lewis Carroll</h2> should
-                    # yield no TOC entry
-                    continue
-
-                try:
-                    depth = int (header.tag[-1:])
-                except ValueError:
-                    depth = 2 # avoid top level 
-
-                # fix bogus header numberings
-                if depth > last_depth + 1:
-                    depth = last_depth + 1
+            toc.add (header)
 
-                last_depth = depth
-
-                # if <h*> is first element of a <div> use <div> instead
-                parent = header.getparent ()
-                if (parent.tag == NS.xhtml.div and
-                    parent[0] == header and
-                    parent.text and
-                    parent.text.strip () == ''):
-                    header = parent
-                    
-                toc.append ( ["%s#%s" % (self.url, get_id (header)), text, depth] )
-
-        return toc
+        return toc.toc
 
 
     def serialize (self):
@@ -509,3 +640,82 @@ class HTMLParserBase (ParserBase):
                                xml_declaration = True,
                                encoding = 'utf-8', 
                                pretty_print = True)
+
+
+class TocBuilder (object):
+    """ Build a TOC from HTML headers, one element at a time.
+
+    Feed it the candidate elements in document order.  tags and
+    classes tell which elements may be candidates.
+
+    """
+
+    tags = TOC_HEADER_TAGS
+    # DP page numbers and DocUtils contents header
+    classes = frozenset (('pageno', 'x-epubmaker-pageno', 'topic-title'))
+
+    def __init__ (self, url):
+        self.url = url
+        self.toc = []
+        self.last_depth = 0
+        self.next_id = 0
+
+
+    def get_id (self, elem):
+        """ Get the id of the element or generate and set one. """
+        if not elem.get ('id'):
+            elem.set ('id', 'pgepubid%05d' % self.next_id)
+            self.next_id += 1
+        return elem.get ('id')
+
+
+    def add (self, header):
+        """ Add a TOC entry for header if it is a header. """
+
+        class_ = header.get ('class', '')
+        if not (header.tag in TOC_HEADER_TAGS or
+                (header.tag.startswith (NS.xhtml['']) and class_.find ('pageno') > -1) or
+                (header.tag == NS.xhtml.p and class_.find ('topic-title') > -1)):
+            return
+
+        text = gg.normalize (etree.tostring (header,
+                                             method = "text",
+                                             encoding = unicode,
+                                             with_tail = False))
+
+        text = header.get ('title', text).strip ()
+
+        if not text:
+            # so <h2 title=""> may be used to suppress TOC entry
+            return
+
+        if class_.find ('pageno') > -1:
+            self.toc.append ( ["%s#%s" % (self.url, self.get_id (header)), text, -1] )
+            return
+
+        # header
+        if text.lower ().startswith ('by '):
+            # common error in PG: <h2>by Lewis Carroll</h2> should
+            # yield no TOC entry
+            return
+
+        try:
+            depth = int (header.tag[-1:])
+        except ValueError:
+            depth = 2 # avoid top level 
+
+        # fix bogus header numberings
+        if depth > self.last_depth + 1:
+            depth = self.last_depth + 1
+
+        self.last_depth = depth
+
+        # if <h*> is first element of a <div> use <div> instead
+        parent = header.getparent ()
+        if (parent.tag == NS.xhtml.div and
+            parent[0] == header and
+            parent.text and
+            parent.text.strip () == ''):
+            header = parent
+
+        self.toc.append ( ["%s#%s" % (self.url, self.get_id (header)), text, depth] )
@@ -20,10 +20,12 @@ import datetime
 import urllib
 import urlparse
 import zipfile
+import zlib
 import time
 import os
-import copy
 import subprocess
+import multiprocessing
+from functools import partial
 
 from lxml import etree
 from lxml.builder import ElementMaker
@@ -33,10 +35,14 @@ import epubmaker.lib.GutenbergGlobals as gg
 from epubmaker.lib.GutenbergGlobals import NS, xpath
 from epubmaker.lib.Logger import info, debug, warn, error, exception
 from epubmaker.lib.MediaTypes import mediatypes as mt 
+from epubmaker.lib import ExternalTools
+from epubmaker.lib import ParallelZip
 from epubmaker import ParserFactory
 from epubmaker import HTMLChunker
+from epubmaker import HTMLCleaner
 from epubmaker import Spider
 from epubmaker import parsers
+from epubmaker.parsers import ImageParser
 from epubmaker import writers
 from epubmaker.Version import VERSION, GENERATOR
 from epubmaker.CommonOptions import Options
@@ -45,6 +51,8 @@ from epubmaker.CommonOptions import Options
 
 MAX_CHUNK_SIZE  = 300 * 1024  # bytes
 
+STREAM_BLOCK_SIZE = 64 * 1024  # bytes
+
 MAX_IMAGE_SIZE  = 127 * 1024  # in bytes
 
 MAX_IMAGE_DIMEN = (800, 1280)  # in pixels
@@ -159,8 +167,14 @@ IMAGE_WRAPPER = """<?xml version="1.0"?>
 
 options = Options()
 
-class OEBPSContainer (zipfile.ZipFile):
-    """ Class representing an OEBPS Container. """
+class OEBPSContainer (ParallelZip.ParallelZipFile):
+    """ Class representing an OEBPS Container.
+
+    Members are compressed in parallel as soon as they are added and
+    written in the order they were added.  Files on disk are streamed
+    into the zip a block at a time.
+
+    """
 
     def __init__ (self, filename, oebps_path = None):
         """ Create the zip file.
@@ -175,7 +189,10 @@ class OEBPSContainer (zipfile.ZipFile):
         info ('Creating Epub file: %s' % filename)
 
         # open zipfile
-        zipfile.ZipFile.__init__ (self, filename, 'w', zipfile.ZIP_DEFLATED)
+        ParallelZip.ParallelZipFile.__init__ (
+            self, filename, zipfile.ZIP_DEFLATED,
+            getattr (options, 'zip_threads', 0),
+            ParallelZip.zip_date_time (getattr (options, 'build_time', None)))
 
         # write mimetype
         # the OCF spec says mimetype must be first and uncompressed
@@ -198,6 +215,7 @@ class OEBPSContainer (zipfile.ZipFile):
     def rollback (self):
         """ Remove OCF Container. """
         debug ("Removing Epub file: %s" % self.zipfilename)
+        self.discard ()
         os.remove (self.zipfilename)
 
         
@@ -217,16 +235,90 @@ class OEBPSContainer (zipfile.ZipFile):
 
 
     def add_file (self, name, url, mediatype = None):
-        """ Add file to zip from bytes string. """
+        """ Add file to zip from file on disk. """
+
+        with open (url, 'rb') as fp:
+            self.add_stream (name, fp, mediatype)
+
+
+    def add_stream (self, name, fp, mediatype = None):
+        """ Add file to zip from file object.
+
+        Like zipfile.ZipFile.write () but reads from an open file and
+        uses our ZipInfo.
+
+        """
+
+        # keep the order of members
+        self.flush ()
+
+        i = self.zi (name)
+        if mediatype and mediatype in (mt.png, mt.gif, mt.jpeg):
+            i.compress_type = zipfile.ZIP_STORED
+        i.CRC = i.file_size = i.compress_size = 0
+        i.header_offset = self.fp.tell ()
+
+        self._writecheck (i)
+        self._didModify = True
+
+        self.fp.write (i.FileHeader ())
 
-        with open (url) as fp:
-            self.add_bytes (name, fp.read (), mediatype)
+        compressor = None
+        if i.compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj (
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        while True:
+            block = fp.read (STREAM_BLOCK_SIZE)
+            if not block:
+                break
+            file_size += len (block)
+            crc = zlib.crc32 (block, crc) & 0xffffffff
+            if compressor:
+                block = compressor.compress (block)
+            compress_size += len (block)
+            self.fp.write (block)
+
+        if compressor:
+            block = compressor.flush ()
+            compress_size += len (block)
+            self.fp.write (block)
+
+        i.CRC = crc
+        i.file_size = file_size
+        i.compress_size = compress_size
+
+        # go back and fix up the local header
+        position = self.fp.tell ()
+        self.fp.seek (i.header_offset)
+        self.fp.write (i.FileHeader ())
+        self.fp.seek (position)
+
+        self.filelist.append (i)
+        self.NameToInfo[i.filename] = i
+
+
+    def add_parser (self, name, p):
+        """ Add file to zip from parser.
+
+        Spilled images are streamed from their temp file.
+
+        """
+
+        spill_filename = getattr (p, 'spill_filename', None)
+        if spill_filename is not None:
+            self.add_file (name, spill_filename, p.mediatype)
+        else:
+            self.add_bytes (name, p.serialize (), p.mediatype)
 
 
     def zi (self, filename = None):
         """ Setup a ZipInfo. """
         z = zipfile.ZipInfo ()
-        z.date_time = time.gmtime ()
+        z.date_time = self.date_time or time.gmtime ()[:6]
         z.compress_type = zipfile.ZIP_DEFLATED
         z.external_attr = 0x81a40000
         if filename:
@@ -451,24 +543,42 @@ class ContentOPF (object):
                                  nsmap = self.nsmap)
         
         self.metadata = self.opf.metadata ()
-        self.manifest = self.opf.manifest ()
-        self.spine    = self.opf.spine ()
         self.guide    = self.opf.guide ()
         self.item_id  = 0
 
+        # the manifest and the spine may get very long, so we keep
+        # them as lightweight records and build the xml at the end
+        self.manifest = []        # [href, id, mediatype, comment]
+        self.manifest_ids = set ()
+        self.spine = []           # (idref, linear)
+        self.spine_attribs = {}
+
     
     def __unicode__ (self):
         """ Serialize content.opf as unicode string. """
 
-        assert len (self.manifest),        'No manifest item in content.opf.'
-        assert len (self.spine),           'No spine item in content.opf.'
-        assert 'toc' in self.spine.attrib, 'No TOC item in content.opf.'
+        assert len (self.manifest),         'No manifest item in content.opf.'
+        assert len (self.spine),            'No spine item in content.opf.'
+        assert 'toc' in self.spine_attribs, 'No TOC item in content.opf.'
+
+        manifest = self.opf.manifest ()
+        for href, id_, mediatype, comment in self.manifest:
+            if comment:
+                manifest.append (etree.Comment (comment))
+            manifest.append (self.opf.item (**{
+                'href': href,
+                'id': id_,
+                'media-type': mediatype}))
+
+        spine = self.opf.spine (**self.spine_attribs)
+        for idref, linear in self.spine:
+            spine.append (self.opf.itemref (idref = idref, linear = linear))
 
         package = self.opf.package (
             **{ 'version': '2.0', 'unique-identifier': 'id' })
         package.append (self.metadata)
-        package.append (self.manifest)
-        package.append (self.spine)
+        package.append (manifest)
+        package.append (spine)
         if len (self.guide):
             package.append (self.guide)
 
@@ -488,8 +598,8 @@ class ContentOPF (object):
     def rewrite_links (self, f):
         """ Rewrite all links through f (). """
         for item in self.manifest:
-            if item.get ('href'):
-                item.set ('href', f (item.get ('href')))
+            if item[0]:
+                item[0] = f (item[0])
         for item in self.guide:
             item.set ('href', f (item.get ('href')))
         
@@ -505,23 +615,21 @@ class ContentOPF (object):
         self.metadata.append (self.opf.meta (name = name, content = content))
 
 
-    def manifest_item (self, url, mediatype, id_ = None):
+    def manifest_item (self, url, mediatype, id_ = None, comment = None):
         """ Add item to manifest. """
 
-        if id_ is None or xpath (self.manifest, "//*[@id = '%s']" % id_):
+        if id_ is None or id_ in self.manifest_ids:
             self.item_id += 1
             id_ = 'item%d' % self.item_id
             
-        self.manifest.append (
-            self.opf.item (**{
-                'href': url,
-                'id': id_,
-                'media-type': mediatype}))
+        self.manifest_ids.add (id_)
+        self.manifest.append ([url, id_, mediatype, comment])
 
         return id_
 
 
-    def spine_item (self, url, mediatype, id_ = None, linear = True, first = False):
+    def spine_item (self, url, mediatype, id_ = None, linear = True, first = False,
+                    comment = None):
         """ Add item to spine and manifest. """
         linear = 'yes' if linear else 'no'
 
@@ -530,42 +638,38 @@ class ContentOPF (object):
             # make a new one
             id_ = None
             
-        id_ = self.manifest_item (url, mediatype, id_)
+        id_ = self.manifest_item (url, mediatype, id_, comment)
         
         # HACK: ADE needs cover flow as first element
         # but we don't know if we have a native coverpage until the manifest is complete
         if first:
-            self.spine.insert (0, 
-                self.opf.itemref (idref = id_, linear = linear))
+            self.spine.insert (0, (id_, linear))
         else:
-            self.spine.append (
-                self.opf.itemref (idref = id_, linear = linear))
+            self.spine.append ((id_, linear))
 
 
     def manifest_item_from_parser (self, p):
         """ Add item to manifest from parser. """
-        if hasattr (p, 'comment') and p.comment:
-            self.manifest.append (etree.Comment (p.comment))
-        return self.manifest_item (p.url, p.mediatype, p.id)
+        return self.manifest_item (p.url, p.mediatype, p.id,
+                                   getattr (p, 'comment', None))
         
 
     def spine_item_from_parser (self, p):
         """ Add item to spine and manifest from parser. """
-        if hasattr (p, 'comment') and p.comment:
-            self.manifest.append (etree.Comment (p.comment))
-        return self.spine_item (p.url, p.mediatype, p.id)
+        return self.spine_item (p.url, p.mediatype, p.id,
+                                comment = getattr (p, 'comment', None))
         
 
     def toc_item (self, url):
         """ Add TOC to manifest and spine. """
         self.manifest_item (url, 'application/x-dtbncx+xml', 'ncx')
-        self.spine.attrib['toc'] = 'ncx'
+        self.spine_attribs['toc'] = 'ncx'
 
 
     def pagemap_item (self, url):
         """ Add page-map to manifest and spine. """
         self.manifest_item (url, 'application/oebps-page-map+xml', 'map')
-        self.spine.attrib['page-map'] = 'map'
+        self.spine_attribs['page-map'] = 'map'
 
 
     def metadata_item (self, dc):
@@ -642,9 +746,9 @@ class ContentOPF (object):
                     dc.release_date.isoformat (), 
                     { NS.opf.event: 'publication'}))
             
-        self.metadata.append (dcterms.date (datetime.datetime.now (
-                    gg.UTC ()).isoformat (), 
-                                  { NS.opf.event: 'conversion'}))
+        self.metadata.append (dcterms.date (
+                (dc.modified or datetime.datetime.now (gg.UTC ())).isoformat (), 
+                { NS.opf.event: 'conversion'}))
 
         source = dc.source
         if hasattr (options.config, 'FILESDIR'):
@@ -667,14 +771,10 @@ class ContentOPF (object):
         id_ = None
 
         # look for a manifest item with the right url
-        for item in xpath (
-            self.manifest,
-            # cannot xpath for default namespace 
-            "//*[local-name () = 'item' and starts-with (@media-type, 'image/jpeg') and @href = $url]", 
-            url = url):
-
-            id_ = item.get ('id')
-            break
+        for href, item_id, mediatype, dummy_comment in self.manifest:
+            if href == url and mediatype.startswith ('image/jpeg'):
+                id_ = item_id
+                break
 
         # else use default cover page image
         if id_ is None:
@@ -684,8 +784,7 @@ class ContentOPF (object):
             except AttributeError:
                 mediatype = mt.jpeg
             try:
-                with open(url, 'r') as f:
-                    ocf.add_bytes (Writer.url2filename (url), f.read(), mediatype)
+                ocf.add_file (Writer.url2filename (url), url, mediatype)
             except IOError:
                 url = 'cover.jpg'
                 ocf.add_bytes (url, resource_string ('epubmaker.writers', url), mediatype)
@@ -703,8 +802,8 @@ class ContentOPF (object):
 
 
 
-class EpubSpider (Spider.Spider):
-    """ A spider that knows about OPS mediatypes. """
+class EpubCrawlPolicy (Spider.CrawlPolicy):
+    """ A crawl policy that knows about OPS mediatypes. """
     
     def is_wanted_doc (self, parser):
         """ Return True if we ought to parse this content document. """
@@ -713,7 +812,7 @@ class EpubSpider (Spider.Spider):
             debug ("Dropping non-ops-content %s" % parser.url)
             return False
 
-        return Spider.Spider.is_wanted_doc (self, parser)
+        return Spider.CrawlPolicy.is_wanted_doc (self, parser)
 
 
     def is_wanted_aux (self, parser):
@@ -722,11 +821,17 @@ class EpubSpider (Spider.Spider):
         # debug ("Is wanted aux? %s" % parser.url)
         if parser.attribs.get ('rel') == 'coverpage':
             return True
-        if Spider.Spider.is_wanted_aux (self, parser):
+        if Spider.CrawlPolicy.is_wanted_aux (self, parser):
             return True
         return parser.mediatype not in OPS_CORE_MEDIATYPES
 
 
+class EpubSpider (Spider.Spider):
+    """ A spider that knows about OPS mediatypes. """
+
+    policy_class = EpubCrawlPolicy
+
+
 class Writer (writers.HTMLishWriter):
     """ Class that writes epub files. """
 
@@ -742,10 +847,10 @@ class Writer (writers.HTMLishWriter):
 
 
     @staticmethod
-    def strip_pagenumbers (xhtml):
+    def strip_pagenumber (elem):
         """
 
-        Strip dp page numbers.
+        Strip dp page number.
 
         Rationale: DP implements page numbers either with float or
         with absolute positioning. Float is not supported by Kindle.
@@ -761,55 +866,55 @@ class Writer (writers.HTMLishWriter):
 
         # look for elements with a class that is in STRIP_CLASSES
         
-        for elem in xpath (xhtml, "//xhtml:*[@class]"):
-            classes = elem.get ('class').split ()
-            if STRIP_CLASSES.intersection (classes):
-
-                # is there a class on this element that is in DP_PAGENUMBER_CLASSES ?
-                pageno = len (DP_PAGENUMBER_CLASSES.intersection (classes)) > 0
-                
-                # save textual content
-                text = gg.normalize (etree.tostring (elem,
-                                                     method = "text",
-                                                     encoding = unicode,
-                                                     with_tail = False))
-                if len (text) > 10:
-                    # safeguard against removing things that are not pagenumbers
-                    continue
-
-                if not text:
-                    text = elem.get ('title')
-
-                # look for id anywhere inside element
-                id_ = elem.xpath (".//@id")
-
-                # transmogrify element into empty <a>
-                tail = elem.tail
-                elem.clear ()
-                elem.tag = NS.xhtml.a
-                if id_:
-                    # some blockheaded PPers include more than
-                    # one page number in one span. take the last id
-                    # because the others represent empty pages.
-                    elem.set ('id', id_[-1])
-                if pageno:
-                    # avoid conflicts with class pageno in input css files
-                    # we actually don't need this class for styling 
-                    # anyway because it is on an empty element
-                    elem.set ('class', 'x-epubmaker-pageno')
-                if text:
-                    elem.set ('title', text)
-                elem.tail = tail
-                
-                # The OPS Spec 2.0 is very clear: "Reading Systems
-                # must be XML processors as defined in XML 1.1."
-                # Nevertheless many browser-plugin ebook readers use
-                # the HTML parsers of the browser.  But HTML parsers
-                # don't grok the minimized form of empty elements.
-                #
-                # This will force lxml to output the non-minimized form
-                # of the element.
-                elem.text = ''
+        classes = elem.get ('class', '').split ()
+        if not STRIP_CLASSES.intersection (classes):
+            return
+
+        # is there a class on this element that is in DP_PAGENUMBER_CLASSES ?
+        pageno = len (DP_PAGENUMBER_CLASSES.intersection (classes)) > 0
+
+        # save textual content
+        text = gg.normalize (etree.tostring (elem,
+                                             method = "text",
+                                             encoding = unicode,
+                                             with_tail = False))
+        if len (text) > 10:
+            # safeguard against removing things that are not pagenumbers
+            return
+
+        if not text:
+            text = elem.get ('title')
+
+        # look for id anywhere inside element
+        id_ = elem.xpath (".//@id")
+
+        # transmogrify element into empty <a>
+        tail = elem.tail
+        elem.clear ()
+        elem.tag = NS.xhtml.a
+        if id_:
+            # some blockheaded PPers include more than
+            # one page number in one span. take the last id
+            # because the others represent empty pages.
+            elem.set ('id', id_[-1])
+        if pageno:
+            # avoid conflicts with class pageno in input css files
+            # we actually don't need this class for styling 
+            # anyway because it is on an empty element
+            elem.set ('class', 'x-epubmaker-pageno')
+        if text:
+            elem.set ('title', text)
+        elem.tail = tail
+
+        # The OPS Spec 2.0 is very clear: "Reading Systems
+        # must be XML processors as defined in XML 1.1."
+        # Nevertheless many browser-plugin ebook readers use
+        # the HTML parsers of the browser.  But HTML parsers
+        # don't grok the minimized form of empty elements.
+        #
+        # This will force lxml to output the non-minimized form
+        # of the element.
+        elem.text = ''
 
 
     @staticmethod
@@ -840,14 +945,13 @@ class Writer (writers.HTMLishWriter):
     }
 
     @staticmethod
-    def fix_charset (xhtml):
+    def fix_charset (node):
         """ Replace some characters that are not widely supported. """
 
-        for node in xhtml.iter ():
-            if node.text:
-                node.text = unicode (node.text).translate (Writer.translate_map)
-            if node.tail:
-                node.tail = unicode (node.tail).translate (Writer.translate_map)
+        if node.text:
+            node.text = unicode (node.text).translate (Writer.translate_map)
+        if node.tail:
+            node.tail = unicode (node.tail).translate (Writer.translate_map)
         
         
     @staticmethod
@@ -863,64 +967,65 @@ class Writer (writers.HTMLishWriter):
 
 
     @staticmethod
-    def fix_style_elements (xhtml):
-        """ Fixup CSS style elements """
+    def fix_style_element (style):
+        """ Fixup CSS style element """
 
-        for style in xpath (xhtml, "//xhtml:style"):
-            p = parsers.CSSParser.Parser ()
-            p.parse_string (style.text.encode ('utf-8'))
-            p.drop_floats ()
-            try:
-                # pylint: disable=E1103
-                style.text = p.sheet.cssText.decode ('utf-8')
-            except ValueError:
-                debug ("CSS:\n%s" % p.sheet.cssText)
-                raise
+        if not style.text:
+            return
+
+        p = parsers.CSSParser.Parser ()
+        p.parse_string (style.text.encode ('utf-8'))
+        p.drop_floats ()
+        try:
+            # pylint: disable=E1103
+            style.text = p.sheet.cssText.decode ('utf-8')
+        except ValueError:
+            debug ("CSS:\n%s" % p.sheet.cssText)
+            raise
         
         
                 
     @staticmethod
-    def strip_ins (xhtml):
-        """ Strip all <ins> tags.
+    def strip_ins (ins):
+        """ Strip <ins> tag.
 
         There's a bug in the epub validator that trips on class and
         title attributes in <ins> elements.
         
         """
 
-        for ins in xpath (xhtml, '//xhtml:ins'):
-            ins.drop_tag ()
-            #if 'class' in ins.attrib:
-            #    del ins.attrib['class']
-            #if 'title' in ins.attrib:
-            #    del ins.attrib['title']
+        ins.drop_tag ()
+        #if 'class' in ins.attrib:
+        #    del ins.attrib['class']
+        #if 'title' in ins.attrib:
+        #    del ins.attrib['title']
 
 
     @staticmethod
-    def strip_noepub (xhtml):
-        """ Strip all <* class='x-epubmaker-drop'> tags.
+    def strip_noepub (e):
+        """ Strip <* class='x-epubmaker-drop'> tag.
 
         As a way to tailor your html towards epub.
         
         """
 
-        for e in xpath (xhtml, "//xhtml:*[contains (@class, 'x-epubmaker-drop')]"):
+        if 'x-epubmaker-drop' in e.get ('class', '').split ():
             e.drop_tree ()
 
 
     @staticmethod
-    def strip_rst_dropcaps (xhtml):
+    def strip_rst_dropcaps (e):
         """ Replace <img class='dropcap'> with <span class='dropcap'>.
 
         """
 
-        for e in xpath (xhtml, "//xhtml:img[@class ='dropcap']"):
+        if e.tag == NS.xhtml.img and e.get ('class') == 'dropcap':
             e.tag = NS.xhtml.span
             e.text = e.get ('alt', '')
 
 
     @staticmethod
-    def reflow_pre (xhtml):
+    def reflow_pre (pre):
         """ make <pre> reflowable.
         
         This helps a lot with readers like Sony's that cannot
@@ -931,31 +1036,33 @@ class Writer (writers.HTMLishWriter):
         def nbsp (matchobj):
             return (' ' * (len (matchobj.group (0)) - 1)) + ' '
 
-        for pre in xpath (xhtml, "//xhtml:pre"):
-            # white-space: pre-wrap would do fine
-            # but it is not supported by OEB
+        if pre.tag != NS.xhtml.pre or pre.getparent () is None:
+            return
+
+        # white-space: pre-wrap would do fine
+        # but it is not supported by OEB
+        try:
+            pre.tag = NS.xhtml.div
+            writers.HTMLishWriter.add_class (pre, 'pgmonospaced')
             try:
-                pre.tag = NS.xhtml.div
-                writers.HTMLishWriter.add_class (pre, 'pgmonospaced')
-                try:
-                    m = parsers.RE_GUTENBERG.search (pre.text)
-                    if (m):
-                        writers.HTMLishWriter.add_class (pre, 'pgheader')
-                except TypeError:
-                    pass
-                tail = pre.tail
-                s = etree.tostring (pre, with_tail=False)
-                s = s.replace ('>\n', '>')      # eliminate that empty first line
-                s = s.replace ('\n', '<br/>')
-                s = re.sub ('  +', nbsp, s)
-                div = etree.fromstring (s)
-                div.tail = tail
-                
-                pre.getparent ().replace (pre, div)
-                
-            except etree.XMLSyntaxError, what:
-                exception ("%s\n%s" % (s, what))
-                raise
+                m = parsers.RE_GUTENBERG.search (pre.text)
+                if (m):
+                    writers.HTMLishWriter.add_class (pre, 'pgheader')
+            except TypeError:
+                pass
+            tail = pre.tail
+            s = etree.tostring (pre, with_tail=False)
+            s = s.replace ('>\n', '>')      # eliminate that empty first line
+            s = s.replace ('\n', '<br/>')
+            s = re.sub ('  +', nbsp, s)
+            div = etree.fromstring (s)
+            div.tail = tail
+
+            pre.getparent ().replace (pre, div)
+
+        except etree.XMLSyntaxError, what:
+            exception ("%s\n%s" % (s, what))
+            raise
 
 
     @staticmethod
@@ -1040,93 +1147,194 @@ class Writer (writers.HTMLishWriter):
         
         
     @staticmethod    
-    def fix_html_image_dimensions (xhtml):
+    def fix_html_image_dimensions (img):
         """
 
-        Remove all width and height that is not specified in '%'.
+        Remove width and height that is not specified in '%'.
 
         """
 
-        for img in xpath (xhtml, '//xhtml:img'):
-            a = img.attrib
+        a = img.attrib
 
-            if ('%' in a.get ('width', '%') and '%' in a.get ('height', '%')):
-                continue
+        if ('%' in a.get ('width', '%') and '%' in a.get ('height', '%')):
+            return
 
-            if 'width' in a:
-                del a['width']
-            if 'height' in a:
-                del a['height']
+        if 'width' in a:
+            del a['width']
+        if 'height' in a:
+            del a['height']
 
 
-    def remove_coverpage (self, xhtml, url):
-        """ Remove coverpage from flow.
+    @staticmethod
+    def remove_coverpage (url):
+        """ Make a rule that removes the coverpage from flow.
 
         EPUB readers will display the coverpage from the manifest and
         if we don't remove it from flow it will be displayed twice.
 
         """
-        for img in xpath (xhtml, '//xhtml:img[@src = $url]', url = url):
-            debug ("remove_coverpage: dropping <img> %s from flow" % url)
-            img.drop_tree ()
-            return # only the first one though
 
+        done = []
 
-    def shipout (self, parsers, ncx):
-        """ Build the zip file. """
+        def remove_coverpage (img):
+            """ Drop the first <img> of url. """
+            if not done and img.get ('src') == url:
+                debug ("remove_coverpage: dropping <img> %s from flow" % url)
+                img.drop_tree ()
+                done.append (img) # only the first one though
 
-        try:
-            ocf = OEBPSContainer (
-                os.path.join (self.options.outputdir, self.options.outputfile),
-                ('%d/' % self.options.ebook if self.options.ebook else None))
+        return remove_coverpage
 
-            opf = ContentOPF ()
 
-            opf.metadata_item (self.options.dc)
+    @staticmethod
+    def pre_clean (url, xhtml):
+        """ Apply the cleanup rules that are the same for every epub.
 
-            # write out parsers
+        Every epub build of the run can share the result.  Returns
+        the TOC of the document.
 
-            for p in parsers:
-                try:
-                    ocf.add_bytes (self.url2filename (p.url), p.serialize (), p.mediatype)
-                    if p.mediatype == 'application/xhtml+xml':
-                        opf.spine_item_from_parser (p)
-                    else:
-                        opf.manifest_item_from_parser (p)
-                except StandardError, what:
-                    error ("Could not process file %s: %s" % (p.url, what))
+        """
 
-            # toc
+        cleaner = HTMLCleaner.HTMLCleaner ()
 
-            for t in ncx.toc:
-                if t[1].lower ().strip (' .') in TOC_HEADERS:
-                    opf.guide_item (t[0], 'toc', t[1])
-                    break
-                    
-            opf.toc_item ('toc.ncx')
-            ocf.add_unicode ('toc.ncx', unicode (ncx))
+        cleaner.add_rule (Writer.strip_pagenumber, classes = STRIP_CLASSES)
 
-            if options.coverpage_url:
-                opf.add_coverpage (ocf, options.coverpage_url)
-            
-            # Adobe page-map
+        # build up TOC
+        # has side effects on xhtml
+        # strip_pagenumber () turns DP page numbers into TOC candidates
+        toc = parsers.TocBuilder (url)
+        cleaner.add_rule (toc.add, toc.tags, toc.classes | DP_PAGENUMBER_CLASSES)
 
-            # opf.pagemap_item ('page-map.xml')
-            # ocf.add_unicode ('page-map.xml', unicode (AdobePageMap (ncx)))
-            
-            # content.opf
+        cleaner.add_rule (Writer.fix_charset)
+        cleaner.add_rule (Writer.fix_style_element, (NS.xhtml.style, ))
 
-            # debug (etree.tostring (opf.manifest, encoding=unicode, pretty_print=True))
-            
-            opf.rewrite_links (self.url2filename)
-            ocf.add_unicode ('content.opf', unicode (opf))
+        # FIXME: remove strip_ins when epubcheck is fixed
+        # epubcheck 1.0.4 is broken
+        # cleaner.add_rule (Writer.strip_ins, (NS.xhtml.ins, ))
+        cleaner.add_rule (Writer.strip_noepub, classes = ('x-epubmaker-drop', ))
+        # cleaner.add_rule (Writer.strip_rst_dropcaps, classes = ('dropcap', ))
+
+        cleaner.add_rule (Writer.fix_html_image_dimensions, (NS.xhtml.img, ))
+
+        # last, because it replaces the <pre> with new elements that
+        # no other rule would see
+        cleaner.add_rule (Writer.reflow_pre, (NS.xhtml.pre, ))
+
+        cleaner.run (xhtml)
+        return toc.toc
+
+
+    @staticmethod
+    def more_epubs_to_build ():
+        """ Will a later build of this run want the pre-cleaned trees? """
+
+        types = getattr (options, 'types', [])
+        type_ = getattr (options, 'type', None)
+        if type_ not in types:
+            return False
+        return any ([t.startswith ('epub.') for t in types[types.index (type_) + 1:]])
+
+
+    def make_cleaner (self, p, xhtml):
+        """ Make the cleanup rules that depend on this build.
+
+        These run after pre_clean ().  All rules run in one walk over
+        the tree.  See HTMLCleaner.
+
+        """
+
+        cleaner = HTMLCleaner.HTMLCleaner ()
+
+        # strip all links to items not in manifest
+        manifest = self.spider.dict_urls_mediatypes ()
+        cleaner.add_rule (lambda elem: p.strip_link (elem, manifest),
+                          (NS.xhtml.link, NS.xhtml.img))
+
+        if options.coverpage_url:
+            cleaner.add_rule (self.remove_coverpage (options.coverpage_url),
+                              (NS.xhtml.img, ))
+
+        # externalize and fix CSS
+        def externalize_css (style):
+            """ Move <style> into external stylesheet. """
+            self.add_external_css (xhtml, style.text, "%d.css" % self.css_count)
+            self.css_count += 1
+            style.drop_tree ()
 
-            ocf.commit ()
+        cleaner.add_rule (externalize_css, (NS.xhtml.style, ))
 
+        return cleaner
+
+
+    def shipout_parser (self, ocf, opf, p):
+        """ Write one parser into the zip file and record it in the opf. """
+
+        try:
+            ocf.add_parser (self.url2filename (p.url), p)
+            p.serialized = True
+            if p.mediatype == 'application/xhtml+xml':
+                opf.spine_item_from_parser (p)
+            else:
+                opf.manifest_item_from_parser (p)
         except StandardError, what:
-            exception ("Error building Epub: %s" % what)
-            ocf.rollback ()
-            raise
+            error ("Could not process file %s: %s" % (p.url, what))
+
+
+    def shipout_chunks (self, ocf, opf, chunker, chunks):
+        """ Write chunks into the zip file and drop them.
+
+        The documents the chunks link to must have been split.
+
+        """
+
+        for chunk in chunks:
+            chunker.rewrite_chunk_internal_links (chunk)
+            # make absolute links zip-filename-compatible
+            chunker.rewrite_chunk_links (chunk, self.url2filename)
+
+            # these parsers never actually parsed anything
+            # we use them to just hold our data
+            p = ParserFactory.ParserFactory.get ('application/xhtml+xml')
+            p.mediatype = 'application/xhtml+xml'
+            p.comment = chunk['comment']
+            p.url = chunk['name']
+            p.xhtml = chunk['chunk']
+            p.id = chunk['id']
+            self.shipout_parser (ocf, opf, p)
+            chunk['chunk'] = chunk['links'] = p.xhtml = None
+
+
+    def shipout (self, ocf, opf, ncx):
+        """ Finish the zip file.
+
+        All parsers have already been written by shipout_parser ().
+
+        """
+
+        # toc
+
+        for t in ncx.toc:
+            if t[1].lower ().strip (' .') in TOC_HEADERS:
+                opf.guide_item (t[0], 'toc', t[1])
+                break
+
+        opf.toc_item ('toc.ncx')
+        ocf.add_unicode ('toc.ncx', unicode (ncx))
+
+        if options.coverpage_url:
+            opf.add_coverpage (ocf, options.coverpage_url)
+
+        # Adobe page-map
+
+        # opf.pagemap_item ('page-map.xml')
+        # ocf.add_unicode ('page-map.xml', unicode (AdobePageMap (ncx)))
+
+        # content.opf
+
+        opf.rewrite_links (self.url2filename)
+        ocf.add_unicode ('content.opf', unicode (opf))
+
+        ocf.commit ()
 
 
     def validate (self):
@@ -1140,12 +1348,13 @@ class Writer (writers.HTMLishWriter):
         for validator in (options.config.EPUB_VALIDATOR, options.config.EPUB_PREFLIGHT):
             if validator is not None:
                 params = validator.split () + [filename]
-                checker = subprocess.Popen (params,
-                                    stdin = subprocess.PIPE, 
-                                    stdout = subprocess.PIPE, 
-                                    stderr = subprocess.PIPE)
+                with ExternalTools.slot ():
+                    checker = subprocess.Popen (params,
+                                        stdin = subprocess.PIPE, 
+                                        stdout = subprocess.PIPE, 
+                                        stderr = subprocess.PIPE)
 
-                (dummy_stdout, stderr) = checker.communicate ()
+                    (dummy_stdout, stderr) = checker.communicate ()
                 if (stderr):
                     error (stderr)
                     return 1
@@ -1160,35 +1369,55 @@ class Writer (writers.HTMLishWriter):
         """ Build epub """
 
         ncx = TocNCX (self.options.dc)
-        parsers = []
-        css_count = 0
+        self.css_count = 0
 
         # add CSS parser
         self.add_external_css (None, PRIVATE_CSS, 'pgepub.css')
 
+        ocf = None
         try:
+            # open the zip file now and write every member as soon as
+            # it is ready, so we never hold the whole book in memory
+            ocf = OEBPSContainer (
+                os.path.join (self.options.outputdir, self.options.outputfile),
+                ('%d/' % self.options.ebook if self.options.ebook else None))
+
+            opf = ContentOPF ()
+            opf.metadata_item (self.options.dc)
+
             chunker = HTMLChunker.HTMLChunker ()
             
             # do images first as we need the new dimensions later
+            jobs = []
+            ids = []
             for p in self.spider.parsers:
                 if hasattr (p, 'resize_image'):
                     if self.options.maintype == 'kindle':
                         if p.url == options.coverpage_url:
-                            np = p.resize_image (MAX_IMAGE_SIZE_KINDLE, MAX_COVER_DIMEN_KINDLE, 'jpeg')
-                            np.id = p.attribs.get ('id', 'coverpage')
-                            id_coverpage = np.id
+                            jobs.append ((p, MAX_IMAGE_SIZE_KINDLE, MAX_COVER_DIMEN_KINDLE, 'jpeg'))
+                            ids.append (p.attribs.get ('id', 'coverpage'))
                         else:
-                            np = p.resize_image (MAX_IMAGE_SIZE_KINDLE, MAX_IMAGE_DIMEN_KINDLE)
-                            np.id = p.attribs.get ('id')
+                            jobs.append ((p, MAX_IMAGE_SIZE_KINDLE, MAX_IMAGE_DIMEN_KINDLE, None))
+                            ids.append (p.attribs.get ('id'))
                     else:
                         if p.attribs.get ('rel') == 'coverpage':
-                            np = p.resize_image (MAX_IMAGE_SIZE, MAX_COVER_DIMEN)
-                            np.id = p.attribs.get ('id', 'coverpage')
-                            id_coverpage = np.id
+                            jobs.append ((p, MAX_IMAGE_SIZE, MAX_COVER_DIMEN, None))
+                            ids.append (p.attribs.get ('id', 'coverpage'))
                         else:
-                            np = p.resize_image (MAX_IMAGE_SIZE, MAX_IMAGE_DIMEN)
-                            np.id = p.attribs.get ('id')
-                    parsers.append (np)
+                            jobs.append ((p, MAX_IMAGE_SIZE, MAX_IMAGE_DIMEN, None))
+                            ids.append (p.attribs.get ('id'))
+
+            keep_cleaned = self.more_epubs_to_build ()
+
+            # documents whose ids are not yet in the idmap of the chunker
+            unsplit = set ([HTMLChunker.unicode_uri (p.url) for p in self.spider.parsers
+                            if p.mediatype in OPS_CONTENT_DOCUMENTS])
+
+            processes = options.image_processes or multiprocessing.cpu_count ()
+            for n, np in enumerate (ImageParser.resize_images (jobs, processes, downscale = True)):
+                np.id = ids[n]
+                self.shipout_parser (ocf, opf, np)
+                jobs[n][0].serialized = True
 
             for p in self.spider.parsers:
                 if p.mediatype in OPS_CONTENT_DOCUMENTS:
@@ -1210,42 +1439,18 @@ class Writer (writers.HTMLishWriter):
                             with open (debugfilename, 'w') as fp:
                                 fp.write (etree.tostring (xhtml, encoding = 'utf-8'))
 
+                        toc = self.pre_clean (p.url, xhtml)
+
                     else:
-                        # make a copy so we can mess around
-                        p.parse ()
-                        xhtml = copy.deepcopy (p.xhtml)
+                        # clean once for all epubs, then get a copy
+                        # so we can mess around
+                        xhtml, toc = p.cleaned_xhtml (
+                            'epub', partial (self.pre_clean, p.url), keep_cleaned)
                         
-                    self.strip_pagenumbers (xhtml)
-
-                    # build up TOC
-                    # has side effects on xhtml
-                    ncx.toc += p.make_toc (xhtml)
+                    self.make_cleaner (p, xhtml).run (xhtml)
+                    ncx.toc += [list (entry) for entry in toc]
 
                     self.insert_root_div (xhtml)
-                    self.fix_charset (xhtml)
-                    self.fix_style_elements (xhtml)
-                    self.reflow_pre (xhtml)
-
-                    # strip all links to items not in manifest
-                    p.strip_links (xhtml, self.spider.dict_urls_mediatypes ())
-
-                    # FIXME: remove strip_ins when epubcheck is fixed
-                    # epubcheck 1.0.4 is broken
-                    # self.strip_ins (xhtml)
-                    self.strip_noepub (xhtml)
-                    # self.strip_rst_dropcaps (xhtml)
-
-                    self.fix_html_image_dimensions (xhtml)
-                    if options.coverpage_url:
-                        self.remove_coverpage (xhtml, options.coverpage_url)
-
-                    # externalize and fix CSS
-                    for style in xpath (xhtml, '//xhtml:style'):
-                        self.add_external_css (
-                            xhtml, style.text, "%d.css" % css_count)
-                        css_count += 1
-                        style.drop_tree ()
-                        
                     self.add_external_css (xhtml, None, 'pgepub.css')
                     
                     self.add_meta_generator (xhtml)
@@ -1253,42 +1458,38 @@ class Writer (writers.HTMLishWriter):
                     debug ("Splitting %s ..." % p.url)
                     chunker.next_id = 0
                     chunker.split (xhtml, p.url)
+                    p.serialized = True
+
+                    # write out every chunk whose links we can resolve
+                    unsplit.discard (HTMLChunker.unicode_uri (p.url))
+                    self.shipout_chunks (ocf, opf, chunker,
+                                         chunker.pop_ready_chunks (unsplit))
 
             for p in self.spider.parsers:
                 if p.mediatype == 'text/css':
                     p.parse()
                     self.fix_css (p.sheet)
                     p.rewrite_links (self.url2filename)
-                    parsers.append (p)
+                    self.shipout_parser (ocf, opf, p)
                         
+            # all documents are split now
+            self.shipout_chunks (ocf, opf, chunker, chunker.pop_ready_chunks (set ()))
+
             # after splitting html into chunks we have to rewrite all
-            # internal links in HTML
-            chunker.rewrite_internal_links ()
-            # also in the TOC
+            # internal links in the TOC
             if not ncx.toc:
                 ncx.toc.append ([self.spider.parsers[0].url, 'Start', 1])
             chunker.rewrite_internal_links_toc (ncx.toc)
 
             # make absolute links zip-filename-compatible
-            chunker.rewrite_links (self.url2filename)
             ncx.rewrite_links (self.url2filename)
 
-            # do away with chunker, copy chunks into new parsers
-            for chunk in chunker.chunks:
-                # these parsers never actually parsed anything
-                # we use them to just hold our data
-                p = ParserFactory.ParserFactory.get ('application/xhtml+xml')
-                p.mediatype = 'application/xhtml+xml'
-                p.comment = chunk['comment']
-                p.url = chunk['name']
-                p.xhtml = chunk['chunk']
-                p.id = chunk['id']
-                parsers.append (p)
-
-            self.shipout (parsers, ncx)
+            self.shipout (ocf, opf, ncx)
 
         except StandardError, what:
             exception ("Error building Epub: %s" % what)
+            if ocf is not None:
+                ocf.rollback ()
             raise
 
 
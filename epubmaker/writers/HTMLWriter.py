@@ -16,7 +16,6 @@ Writes an HTML file
 from __future__ import with_statement
 
 import os
-import copy
 
 from lxml import etree
 from pkg_resources import resource_string # pylint: disable=E0611
@@ -66,13 +65,20 @@ class Writer (writers.HTMLishWriter):
                 # Do html only. The images were copied earlier by PicsDirWriter.
 
                 xhtml = None
+                journal = None
                 if hasattr (p, 'rst2html'):
                     xhtml = p.rst2html ()
                 elif hasattr (p, 'xhtml'):
+                    # work on the parsed tree and undo our changes
+                    # afterwards, other writers want it too
                     p.parse ()
-                    xhtml = copy.deepcopy (p.xhtml)
+                    xhtml = p.xhtml
+                    journal = writers.TreeJournal (xhtml)
 
-                if xhtml is not None:
+                if xhtml is None:
+                    continue
+
+                try:
                     self.make_links_relative (xhtml, p.url)
 
                     self.add_dublincore (xhtml)
@@ -94,6 +100,11 @@ class Writer (writers.HTMLishWriter):
                                            xml_declaration = True)
                     
                     self.write_with_crlf (htmlfilename, html)
+                    p.serialized = True
+
+                finally:
+                    if journal is not None:
+                        journal.rollback ()
 
             # self.copy_aux_files (self.options.outputdir)
         
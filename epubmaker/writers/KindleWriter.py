@@ -17,7 +17,9 @@ import subprocess
 
 from epubmaker.lib.Logger import info, debug, warn, error
 from epubmaker.lib.GutenbergGlobals import SkipOutputFormat
+from epubmaker.lib import ExternalTools
 from epubmaker.writers import EpubWriter
+from epubmaker import BuildManifest
 from epubmaker.CommonOptions import Options
 
 options = Options()
@@ -32,6 +34,13 @@ class Writer (EpubWriter.Writer):
         self.setup (options)
 
 
+    def get_dependencies (self):
+        """ The kindle file is built from the epub file. """
+
+        epub_filename = os.path.join (self.options.outputdir, self.options.epub_filename)
+        return { epub_filename: BuildManifest.hash_url (epub_filename) }
+
+
     def build (self):
         """ Build kindle file. """
 
@@ -62,20 +71,21 @@ class Writer (EpubWriter.Writer):
         info ("            ... from: %s" % os.path.join (
             self.options.outputdir, epub_filename))
 
-        try:
-            cwd = os.getcwd ()
-            os.chdir (self.options.outputdir)
+        with ExternalTools.slot ():
+            try:
+                cwd = os.getcwd ()
+                os.chdir (self.options.outputdir)
 
-            kindlegen = subprocess.Popen (
-                [options.config.MOBIGEN, '-o', os.path.basename (kindle_filename), epub_filename],
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                kindlegen = subprocess.Popen (
+                    [options.config.MOBIGEN, '-o', os.path.basename (kindle_filename), epub_filename],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-        except OSError, what:
-            os.chdir (cwd)
-            error ("KindleWriter: %s %s" % (options.config.MOBIGEN, what))
-            raise SkipOutputFormat
-        
-        (stdout, stderr) = kindlegen.communicate ('')
+            except OSError, what:
+                os.chdir (cwd)
+                error ("KindleWriter: %s %s" % (options.config.MOBIGEN, what))
+                raise SkipOutputFormat
+
+            (stdout, stderr) = kindlegen.communicate ('')
 
         # try:
         #     # if self.options.verbose < 2:
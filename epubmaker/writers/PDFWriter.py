@@ -19,6 +19,7 @@ import subprocess
 
 from epubmaker.lib.Logger import debug, info, warn, error
 from epubmaker.lib.GutenbergGlobals import SkipOutputFormat
+from epubmaker.lib import ExternalTools
 
 from epubmaker import ParserFactory
 from epubmaker import writers
@@ -61,24 +62,26 @@ class Writer (writers.BaseWriter):
         tex = parser.rst2xetex ()
         with open (texfilename, 'w') as fp:
             fp.write (tex.encode ('utf-8'))
+        parser.serialized = True
 
-        try:
-            cwd = os.getcwd ()
-            os.chdir (self.options.outputdir)
-
-            _xetex = subprocess.Popen ([options.config.XELATEX,
-                                        "-output-directory", self.options.outputdir,
-                                        "-interaction", "nonstopmode",
-                                        texfilename],
-                                       stdin = subprocess.PIPE, 
-                                       stdout = subprocess.PIPE, 
-                                       stderr = subprocess.PIPE)
-        except OSError, what:
-            os.chdir (cwd)
-            error ("PDFWriter: %s %s" % (options.config.XELATEX, what))
-            raise SkipOutputFormat
-
-        (dummy_stdout, dummy_stderr) = _xetex.communicate ()
+        with ExternalTools.slot ():
+            try:
+                cwd = os.getcwd ()
+                os.chdir (self.options.outputdir)
+
+                _xetex = subprocess.Popen ([options.config.XELATEX,
+                                            "-output-directory", self.options.outputdir,
+                                            "-interaction", "nonstopmode",
+                                            texfilename],
+                                           stdin = subprocess.PIPE, 
+                                           stdout = subprocess.PIPE, 
+                                           stderr = subprocess.PIPE)
+            except OSError, what:
+                os.chdir (cwd)
+                error ("PDFWriter: %s %s" % (options.config.XELATEX, what))
+                raise SkipOutputFormat
+
+            (dummy_stdout, dummy_stderr) = _xetex.communicate ()
         
         with open (logfilename) as fp:
             for line in fp:
@@ -74,6 +74,7 @@ class Writer (writers.BaseWriter):
                 try:
                     with open (fn_dest, 'wb') as fp_dest:
                         fp_dest.write (p.serialize ())
+                    p.serialized = True
                 except IOError, what:
                     error ('Cannot copy %s to %s: %s' % (src_uri, fn_dest, what))
 
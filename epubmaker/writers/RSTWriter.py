@@ -41,6 +41,7 @@ class Writer (writers.BaseWriter):
         data = parser.preprocess ('utf-8').encode ('utf-8')
 
         self.write_with_crlf (filename, data)
+        parser.serialized = True
         
         info ("Done RST file: %s" % filename)
 
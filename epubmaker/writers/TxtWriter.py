@@ -20,6 +20,7 @@ import subprocess
 
 from epubmaker.lib.Logger import debug, info, warn, error
 from epubmaker.lib.GutenbergGlobals import SkipOutputFormat
+from epubmaker.lib import ExternalTools
 
 from epubmaker import ParserFactory
 from epubmaker import writers
@@ -63,19 +64,20 @@ class Writer (writers.BaseWriter):
                 pass
 
         # call groff
-        try:
-            _groff = subprocess.Popen ([options.config.GROFF, 
-                                       "-t",             # preprocess with tbl
-                                       "-K", device,     # input encoding
-                                       "-T", device],    # output device
-                                      stdin = subprocess.PIPE, 
-                                      stdout = subprocess.PIPE, 
-                                      stderr = subprocess.PIPE)
-        except OSError:
-            error ("TxtWriter: executable not found: %s" % options.config.GROFF)
-            raise SkipOutputFormat
-
-        (txt, stderr) = _groff.communicate (nroff)
+        with ExternalTools.slot ():
+            try:
+                _groff = subprocess.Popen ([options.config.GROFF, 
+                                           "-t",             # preprocess with tbl
+                                           "-K", device,     # input encoding
+                                           "-T", device],    # output device
+                                          stdin = subprocess.PIPE, 
+                                          stdout = subprocess.PIPE, 
+                                          stderr = subprocess.PIPE)
+            except OSError:
+                error ("TxtWriter: executable not found: %s" % options.config.GROFF)
+                raise SkipOutputFormat
+
+            (txt, stderr) = _groff.communicate (nroff)
         
         # pylint: disable=E1103
         for line in stderr.splitlines ():
@@ -111,6 +113,7 @@ class Writer (writers.BaseWriter):
         data = data.encode ('utf_8_sig' if encoding == 'utf-8' else encoding, 'unitame')
 
         self.write_with_crlf (filename, data)
+        parser.serialized = True
             
         info ("Done plain text file: %s" % filename)
 
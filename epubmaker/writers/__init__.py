@@ -28,6 +28,8 @@ from epubmaker.lib import MediaTypes
 
 from epubmaker import ParserFactory
 from epubmaker import Spider
+from epubmaker import BuildManifest
+from epubmaker.mydocutils import broken
 from epubmaker.Version import VERSION, GENERATOR
 
 
@@ -112,6 +114,24 @@ class BaseWriter (object):
         xhtml.rewrite_links (partial (gg.make_url_relative, base_url))
 
 
+    def get_dependencies (self):
+        """ Return a dict of url -> sha1 of every input to the output. """
+
+        deps = {}
+        for p in self.spider.parsers:
+            if p.url.endswith (broken):
+                # our own resource
+                continue
+            if p.fp is None and p.buffer is None:
+                # generated by the writer, eg. an external stylesheet,
+                # covered by the config hash and the real inputs
+                continue
+            data = p.bytes_content ()
+            if data is not None:
+                deps[p.url] = BuildManifest.hash_data (data)
+        return deps
+
+
     def get_aux_file_list (self):
         """ Iterate over image files. Return absolute urls. """
 
@@ -124,6 +144,42 @@ em = ElementMaker (namespace = str (gg.NS.xhtml),
                    nsmap = { None: str (gg.NS.xhtml) })
 
 
+class TreeJournal (object):
+    """ Undo the changes a writer makes to the links and the <head>
+    of a shared tree.
+
+    Lets a writer change the parsed tree in place while it serializes
+    it, instead of working on a deep copy of the whole tree.  The
+    writer may rewrite links and append elements to <head>.
+
+    """
+
+    def __init__ (self, xhtml):
+        self.attribs = {} # elem -> (attributes, text)
+        for elem, dummy_attr, dummy_link, dummy_pos in xhtml.iterlinks ():
+            if elem not in self.attribs:
+                self.attribs[elem] = (elem.items (), elem.text)
+
+        self.heads = [(head, list (head)) for head in gg.xpath (xhtml, '//xhtml:head')]
+
+
+    def rollback (self):
+        """ Restore the tree. """
+
+        for elem, (attribs, text) in self.attribs.iteritems ():
+            for name, value in attribs:
+                # set only what changed, to keep the attribute order
+                if elem.get (name) != value:
+                    elem.set (name, value)
+            if elem.text != text:
+                elem.text = text
+
+        for head, children in self.heads:
+            for child in list (head):
+                if child not in children:
+                    head.remove (child)
+
+
 class HTMLishWriter (BaseWriter):
     """ Base class for writers with HTMLish contents. """
 
@@ -38,19 +38,26 @@ ibiblio_packages = pypi_packages + [
     ]
 
 pypi_py_modules = [
+    'epubmaker.BuildManifest',
     'epubmaker.CommonOptions',
     'epubmaker.EpubMaker',
     'epubmaker.HTMLChunker',
+    'epubmaker.HTMLCleaner',
     'epubmaker.ParserFactory',
     'epubmaker.Spider',
     'epubmaker.Unitame',
     'epubmaker.UnitameData',
     'epubmaker.Version',
 
+    'epubmaker.lib.ArchiveURL',
+    'epubmaker.lib.Cache',
     'epubmaker.lib.DublinCore',
+    'epubmaker.lib.ExternalTools',
     'epubmaker.lib.GutenbergGlobals',
+    'epubmaker.lib.HTTPPool',
     'epubmaker.lib.Logger',
     'epubmaker.lib.MediaTypes',
+    'epubmaker.lib.ParallelZip',
 
     'epubmaker.WriterFactory',
     ]
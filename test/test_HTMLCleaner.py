@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+test_HTMLCleaner.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Tests for the one-walk cleanup rules.
+
+"""
+
+import unittest
+
+from lxml import etree
+
+from epubmaker.lib.GutenbergGlobals import NS
+from epubmaker.HTMLCleaner import HTMLCleaner
+
+HTML = """
+<html xmlns="http://www.w3.org/1999/xhtml">
+  <body>
+    <div class="drop">
+      <p class="mark" id="p1"><span class="mark" id="s1">dropped</span></p>
+    </div>
+    <p class="mark" id="p2"><span class="mark" id="s2">kept</span></p>
+  </body>
+</html>
+"""
+
+
+def drop (elem):
+    """ Remove elem from the tree. """
+    elem.getparent ().remove (elem)
+
+
+class HTMLCleanerTest (unittest.TestCase):
+    """ Test HTMLCleaner.run (). """
+
+    def setUp (self):
+        self.xhtml = etree.fromstring (HTML)
+        self.seen = []
+
+
+    def mark (self, elem):
+        """ Remember the id of every element the rule gets. """
+        self.seen.append (elem.get ('id'))
+
+
+    def test_nested_in_dropped (self):
+        """ Elements inside a dropped subtree are not handed on. """
+
+        cleaner = HTMLCleaner ()
+        cleaner.add_rule (drop, classes = ('drop', ))
+        cleaner.add_rule (self.mark, classes = ('mark', ))
+        cleaner.run (self.xhtml)
+
+        self.assertEqual (self.seen, ['p2', 's2'])
+
+
+    def test_dropped_by_same_walk (self):
+        """ A rule that drops a parent hides its children from later rules. """
+
+        cleaner = HTMLCleaner ()
+        cleaner.add_rule (drop, (NS.xhtml.p, ))
+        cleaner.add_rule (self.mark, (NS.xhtml.span, ))
+        cleaner.run (self.xhtml)
+
+        self.assertEqual (self.seen, [])
+
+
+    def test_document_order (self):
+        """ Every rule sees its elements in document order. """
+
+        cleaner = HTMLCleaner ()
+        cleaner.add_rule (self.mark, (NS.xhtml.p, NS.xhtml.span))
+        cleaner.run (self.xhtml)
+
+        self.assertEqual (self.seen, ['p1', 's1', 'p2', 's2'])
+
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+test_HTTPPool.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Tests for the persistent HTTP connections against a local server.
+
+"""
+
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+from epubmaker.lib import Cache
+from epubmaker.lib import HTTPPool
+
+BODY = 'Hello, World!'
+ETAG = '"v1"'
+
+
+class Handler (BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves a few test urls. """
+
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def setup (self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup (self)
+        self.server.connections += 1
+
+
+    def send_body (self, status, body, headers = {}):
+        """ Send a response with body. """
+
+        self.send_response (status)
+        self.send_header ('Content-Type', 'text/plain')
+        self.send_header ('Content-Length', str (len (body)))
+        for name, value in headers.items ():
+            self.send_header (name, value)
+        self.end_headers ()
+        self.wfile.write (body)
+
+
+    def do_GET (self):
+        self.server.requests.append (self.path)
+
+        if self.path == '/plain':
+            self.send_body (200, BODY)
+
+        elif self.path == '/hangup':
+            # close the connection without telling the client
+            self.send_body (200, BODY)
+            self.close_connection = 1
+
+        elif self.path == '/redirect':
+            self.send_body (302, '', { 'Location': '/plain' })
+
+        elif self.path == '/etag':
+            if self.headers.getheader ('if-none-match') == ETAG:
+                self.server.statuses.append (304)
+                self.send_response (304)
+                self.send_header ('ETag', ETAG)
+                self.end_headers ()
+            else:
+                self.server.statuses.append (200)
+                self.send_body (200, BODY, { 'ETag': ETAG })
+
+        else:
+            self.send_body (404, 'Not Found')
+
+
+    def log_message (self, *args):
+        pass
+
+
+class Server (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A local test server. """
+
+    daemon_threads = True
+
+    def __init__ (self):
+        BaseHTTPServer.HTTPServer.__init__ (self, ('127.0.0.1', 0), Handler)
+        self.connections = 0
+        self.requests = []
+        self.statuses = []
+
+
+class HTTPPoolTest (unittest.TestCase):
+    """ Test HTTPPool against a local server. """
+
+    def setUp (self):
+        self.server = Server ()
+        self.thread = threading.Thread (target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start ()
+        self.base = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.pool = HTTPPool.HTTPPool ()
+        self.cachedir = tempfile.mkdtemp ()
+        Cache.setup (None)
+
+
+    def tearDown (self):
+        Cache.setup (None)
+        shutil.rmtree (self.cachedir)
+        self.server.shutdown ()
+        self.server.server_close ()
+
+
+    def test_keep_alive (self):
+        """ Requests to the same host reuse the connection. """
+
+        for dummy_n in range (3):
+            self.assertEqual (self.pool.urlopen (self.base + '/plain').read (), BODY)
+        self.assertEqual (self.server.requests, ['/plain'] * 3)
+        self.assertEqual (self.server.connections, 1)
+
+
+    def test_stale_connection (self):
+        """ A request on a connection closed by the server is retried. """
+
+        self.assertEqual (self.pool.urlopen (self.base + '/hangup').read (), BODY)
+        self.assertEqual (self.pool.urlopen (self.base + '/plain').read (), BODY)
+        self.assertEqual (self.server.requests, ['/hangup', '/plain'])
+        self.assertEqual (self.server.connections, 2)
+
+
+    def test_redirect (self):
+        """ Redirects are followed and geturl () returns the target. """
+
+        fp = self.pool.urlopen (self.base + '/redirect')
+        self.assertEqual (fp.read (), BODY)
+        self.assertEqual (fp.geturl (), self.base + '/plain')
+        self.assertEqual (self.server.requests, ['/redirect', '/plain'])
+
+
+    def test_not_found (self):
+        """ Errors raise IOError. """
+
+        self.assertRaises (IOError, self.pool.urlopen, self.base + '/missing')
+
+
+    def test_conditional_get (self):
+        """ A 304 response is answered from the cache. """
+
+        Cache.setup (self.cachedir)
+
+        fp = self.pool.urlopen (self.base + '/etag')
+        self.assertEqual (fp.read (), BODY)
+
+        fp = self.pool.urlopen (self.base + '/etag')
+        self.assertEqual (fp.read (), BODY)
+        self.assertEqual (fp.getcode (), 200)
+        self.assertEqual (fp.info ().getheader ('etag'), ETAG)
+        self.assertEqual (self.server.statuses, [200, 304])
+
+
+if __name__ == '__main__':
+    unittest.main ()
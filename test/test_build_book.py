@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+test_build_book.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Tests for the incremental builds of build_book ().
+
+"""
+
+import os
+import sys
+import glob
+import json
+import shutil
+import tempfile
+import unittest
+
+from epubmaker import EpubMaker
+from epubmaker import ParserFactory
+from epubmaker import CommonOptions
+from epubmaker.WriterFactory import load_writers
+
+HTML = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN"
+  "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+  <head>
+    <title>A Small Book</title>
+    <meta name="DC.Creator" content="Nobody" />
+    <style type="text/css">p { text-indent: 1em }</style>
+  </head>
+  <body>
+    <h1>A Small Book</h1>
+    <p>Once upon a time.</p>
+    <p>The end.</p>
+  </body>
+</html>
+"""
+
+
+class BuildBookTest (unittest.TestCase):
+    """ Test that build_book () skips outputs that are up to date. """
+
+    def setUp (self):
+        self.tmpdir = tempfile.mkdtemp ()
+        self.outputdir = os.path.join (self.tmpdir, 'out')
+        os.mkdir (self.outputdir)
+
+        self.filename = os.path.join (self.tmpdir, 'book.html')
+        with open (self.filename, 'w') as fp:
+            fp.write (HTML)
+
+        argv = sys.argv
+        try:
+            sys.argv = ['epubmaker', '--make', 'epub',
+                        '--output-dir', self.outputdir,
+                        '--cache-dir', os.path.join (self.tmpdir, 'cache'),
+                        self.filename]
+            options, dummy_args = CommonOptions.parse_args (
+                EpubMaker.get_option_parser (), {}, {})
+        finally:
+            sys.argv = argv
+
+        options.types = EpubMaker.expand_types (options.types)
+        ParserFactory.load_parsers ()
+        load_writers ()
+
+
+    def tearDown (self):
+        shutil.rmtree (self.tmpdir)
+
+
+    def test_second_build_skips (self):
+        """ The first build records a manifest, the second skips all. """
+
+        results = EpubMaker.build_book (self.filename)
+        self.assertEqual (sorted (results.keys ()), ['epub.images', 'epub.noimages'])
+        self.assertEqual (set (results.values ()), set (['ok']))
+
+        manifests = glob.glob (os.path.join (self.outputdir, '*-manifest.json'))
+        self.assertEqual (len (manifests), 1)
+        with open (manifests[0]) as fp:
+            outputs = json.load (fp)['outputs']
+        self.assertEqual (sorted ([os.path.splitext (name)[1] for name in outputs]),
+                          ['.epub', '.epub'])
+
+        results = EpubMaker.build_book (self.filename)
+        self.assertEqual (set (results.values ()), set (['uptodate']))
+
+
+if __name__ == '__main__':
+    unittest.main ()
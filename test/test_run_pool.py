@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: iso-8859-1 -*-
+
+"""
+test_run_pool.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Tests for the worker pool of the batch mode.
+
+"""
+
+import os
+import json
+import signal
+import unittest
+import StringIO
+
+from epubmaker import EpubMaker
+from epubmaker.CommonOptions import Options
+
+options = Options()
+
+
+def crashing_worker (index, argv, job, url, packager_factory, conn):
+    """ A worker that dies without sending a record. """
+    os._exit (1)
+
+
+def alarm (dummy_signum, dummy_frame):
+    """ Fail instead of hanging forever. """
+    raise AssertionError ("run_pool hangs")
+
+
+class RunPoolTest (unittest.TestCase):
+    """ Test run_pool (). """
+
+    def setUp (self):
+        self.pool_worker = EpubMaker.pool_worker
+        options.jobs = 2
+        options.job_timeout = 60
+        options.max_tools = 0
+        signal.signal (signal.SIGALRM, alarm)
+        signal.alarm (30)
+
+
+    def tearDown (self):
+        signal.alarm (0)
+        EpubMaker.pool_worker = self.pool_worker
+
+
+    def test_crashed_worker (self):
+        """ A worker that calls os._exit () is recorded as crashed. """
+
+        EpubMaker.pool_worker = crashing_worker
+        outfile = StringIO.StringIO ()
+        jobs = iter ([(['book1.txt'], {}, 'book1.txt'),
+                      (['book2.txt'], {}, 'book2.txt')])
+
+        EpubMaker.run_pool (jobs, None, outfile)
+
+        records = [json.loads (line) for line in outfile.getvalue ().splitlines ()]
+        self.assertEqual (sorted ([r['source'] for r in records]),
+                          ['book1.txt', 'book2.txt'])
+        for record in records:
+            self.assertEqual (record['status'], 'crashed')
+            self.assertEqual (record['exitcode'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main ()